@@ -4,3 +4,33 @@ bind = "127.0.0.1:%(gunicorn_port)s"
 workers = (os.sysconf("SC_NPROCESSORS_ONLN") * 2) + 1
 loglevel = "error"
 proc_name = "%(proj_name)s"
+
+# Load Django and the GIS libraries once in the master; workers share
+# them copy-on-write. See geoanalytics.warmup.
+preload_app = True
+
+# Recycle workers to bound memory growth, each after a slightly
+# different number of requests so they don't all restart at once.
+max_requests = 1000
+max_requests_jitter = 200
+
+
+def when_ready(server):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "geoanalytics.settings")
+    from geoanalytics import warmup
+    warmup.when_ready(server)
+
+
+def pre_fork(server, worker):
+    from geoanalytics import warmup
+    warmup.pre_fork(server, worker)
+
+
+def post_fork(server, worker):
+    from geoanalytics import warmup
+    warmup.post_fork(server, worker)
+
+
+def worker_exit(server, worker):
+    from geoanalytics import warmup
+    warmup.worker_exit(server, worker)
@@ -0,0 +1,34 @@
+import os
+
+# Used by init in the Docker image; unlike the rest of deploy/ this
+# isn't a fab template.
+bind = "0.0.0.0:80"
+workers = int(os.environ.get("GUNICORN_WORKERS", os.sysconf("SC_NPROCESSORS_ONLN") * 2 + 1))
+loglevel = "error"
+proc_name = "geoanalytics"
+
+# See gunicorn.conf.py.
+preload_app = True
+max_requests = 1000
+max_requests_jitter = 200
+
+
+def when_ready(server):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "geoanalytics.settings")
+    from geoanalytics import warmup
+    warmup.when_ready(server)
+
+
+def pre_fork(server, worker):
+    from geoanalytics import warmup
+    warmup.pre_fork(server, worker)
+
+
+def post_fork(server, worker):
+    from geoanalytics import warmup
+    warmup.post_fork(server, worker)
+
+
+def worker_exit(server, worker):
+    from geoanalytics import warmup
+    warmup.worker_exit(server, worker)
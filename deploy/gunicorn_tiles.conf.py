@@ -0,0 +1,40 @@
+import os
+
+# Tile and feature requests (see nginx.conf) mostly wait on Redis,
+# PostGIS or mapnik, which release the GIL, so each process serves
+# many of them at once on a pool of threads. Each thread may hold a
+# database connection, so the pool is kept small, and connections are
+# closed after each request rather than kept open per thread; see
+# DATABASES in deploy/live_settings.py.
+bind = "127.0.0.1:%(gunicorn_tiles_port)s"
+workers = os.sysconf("SC_NPROCESSORS_ONLN")
+worker_class = "gthread"
+threads = 4
+raw_env = ["CONN_MAX_AGE=0"]
+loglevel = "error"
+proc_name = "%(proj_name)s_tiles"
+
+preload_app = True
+max_requests = 5000
+max_requests_jitter = 1000
+
+
+def when_ready(server):
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "geoanalytics.settings")
+    from geoanalytics import warmup
+    warmup.when_ready(server)
+
+
+def pre_fork(server, worker):
+    from geoanalytics import warmup
+    warmup.pre_fork(server, worker)
+
+
+def post_fork(server, worker):
+    from geoanalytics import warmup
+    warmup.post_fork(server, worker)
+
+
+def worker_exit(server, worker):
+    from geoanalytics import warmup
+    warmup.worker_exit(server, worker)
@@ -1,3 +1,13 @@
+# Loaded through the LOCAL_SETTINGS environment variable instead of
+# geoanalytics/settings_local.py, which is for development only.
+
+import os
+
+DEBUG = False
+
+# Rendered from the SECRET_KEY and NEVERCACHE_KEY in FABRIC.
+SECRET_KEY = "%(secret_key)s"
+NEVERCACHE_KEY = "%(nevercache_key)s"
 
 DATABASES = {
     "default": {
@@ -13,6 +23,15 @@ DATABASES = {
         "HOST": "127.0.0.1",
         # Set to empty string for default. Not used with sqlite3.
         "PORT": "",
+        # Keep connections open between requests, except in the tile
+        # server (see deploy/gunicorn_tiles.conf.py), whose threads
+        # would otherwise hold one each. On n CPUs a release then uses
+        # up to 2n + 1 for the app workers and 4n for the tile threads,
+        # and both releases run while traffic moves over: 12n + 2, plus
+        # celery and manage.py. Keep that under PostgreSQL's
+        # max_connections (100 by default), raising it or putting
+        # pgbouncer in front on bigger hosts.
+        "CONN_MAX_AGE": int(os.environ.get("CONN_MAX_AGE", 60)),
     }
 }
 
@@ -29,4 +48,9 @@ CACHES = {
     }
 }
 
-SESSION_ENGINE = "django.contrib.sessions.backends.cache"
+SESSION_ENGINE = "geoanalytics.sessions"
+
+# Shared by both release colours, like the media directory.
+BLOB_ROOT = "%(venv_path)s/blobs"
+
+USE_X_ACCEL_REDIRECT = True
@@ -1,13 +1,18 @@
+import json
 import os
 import re
 import sys
+import time
 from functools import wraps
+from hashlib import sha1
+from StringIO import StringIO
 from getpass import getpass, getuser
 from glob import glob
 from contextlib import contextmanager
 
-from fabric.api import env, cd, prefix, sudo as _sudo, run as _run, hide, task
-from fabric.contrib.files import exists, upload_template
+from fabric.api import (abort, env, cd, execute, prefix, put, runs_once,
+                        settings, sudo as _sudo, run as _run, hide, task)
+from fabric.contrib.files import exists, is_link, upload_template
 from fabric.colors import yellow, green, blue, red
 
 
@@ -30,6 +35,8 @@ if sys.argv[0].split(os.sep)[-1] == "fab":
 
 env.db_pass = conf.get("DB_PASS", None)
 env.admin_pass = conf.get("ADMIN_PASS", None)
+env.secret_key = conf.get("SECRET_KEY", None)
+env.nevercache_key = conf.get("NEVERCACHE_KEY", None)
 env.user = conf.get("SSH_USER", getuser())
 env.password = conf.get("SSH_PASS", None)
 env.key_filename = conf.get("SSH_KEY_PATH", None)
@@ -40,14 +47,37 @@ env.venv_home = conf.get("VIRTUALENV_HOME", "/home/%s" % env.user)
 env.venv_path = "%s/%s" % (env.venv_home, env.proj_name)
 env.proj_dirname = "project"
 env.proj_path = "%s/%s" % (env.venv_path, env.proj_dirname)
-env.manage = "%s/bin/python %s/project/manage.py" % (env.venv_path,
-                                                     env.venv_path)
+env.releases_path = "%s/releases" % env.venv_path
+env.media_path = "%s/media" % env.venv_path
+env.env_path = "%s/env" % env.proj_path
+env.manage = "LOCAL_SETTINGS=local_settings %s/bin/python %s/manage.py" % (
+    env.env_path, env.proj_path)
 env.live_host = conf.get("LIVE_HOSTNAME", env.hosts[0] if env.hosts else None)
 env.repo_url = conf.get("REPO_URL", "")
 env.git = env.repo_url.startswith("git") or env.repo_url.endswith(".git")
 env.reqs_path = conf.get("REQUIREMENTS_PATH", None)
+env.wheelhouse_url = conf.get("WHEELHOUSE_URL", None)
+env.manifest_path = "%s/deploy.manifest" % env.venv_path
 env.gunicorn_port = conf.get("GUNICORN_PORT", 8000)
+env.gunicorn_tiles_port = conf.get("GUNICORN_TILES_PORT", 8001)
 env.locale = conf.get("LOCALE", "en_US.UTF-8")
+env.release_port_offset = conf.get("RELEASE_PORT_OFFSET", 10)
+env.drain_seconds = conf.get("DRAIN_SECONDS", 30)
+env.deploy_pool_size = conf.get("DEPLOY_POOL_SIZE", 4)
+env.deploy_batch_size = conf.get("DEPLOY_BATCH_SIZE", env.deploy_pool_size)
+env.deploy_canary_hosts = conf.get("DEPLOY_CANARY_HOSTS", 1)
+env.health_check_urls = conf.get("HEALTH_CHECK_URLS", ["/"])
+env.backup_path = conf.get("BACKUP_PATH", "%s/backups" % env.venv_path)
+env.backup_jobs = conf.get("BACKUP_JOBS", 4)
+env.backup_compression = conf.get("BACKUP_COMPRESSION", 1)
+env.backup_skip_tables = conf.get("BACKUP_SKIP_TABLES", "deploy/backup_skip_tables")
+
+
+# Releases are built side by side in releases/blue and releases/green,
+# each with its own virtualenv in env/, and the project path is a
+# symlink to the live one. The green release listens on the gunicorn
+# ports plus RELEASE_PORT_OFFSET.
+COLOURS = ("blue", "green")
 
 
 ##################
@@ -62,12 +92,12 @@ templates = {
     "nginx": {
         "local_path": "deploy/nginx.conf",
         "remote_path": "/etc/nginx/sites-enabled/%(proj_name)s.conf",
-        "reload_command": "service nginx restart",
+        "reload_command": "service nginx reload",
     },
     "supervisor": {
         "local_path": "deploy/supervisor.conf",
         "remote_path": "/etc/supervisor/conf.d/%(proj_name)s.conf",
-        "reload_command": "supervisorctl reload",
+        "reload_command": "supervisorctl reread && supervisorctl update",
     },
     "cron": {
         "local_path": "deploy/crontab",
@@ -79,12 +109,28 @@ templates = {
         "local_path": "deploy/gunicorn.conf.py",
         "remote_path": "%(proj_path)s/gunicorn.conf.py",
     },
+    "gunicorn_tiles": {
+        "local_path": "deploy/gunicorn_tiles.conf.py",
+        "remote_path": "%(proj_path)s/gunicorn_tiles.conf.py",
+    },
     "settings": {
         "local_path": "deploy/live_settings.py",
         "remote_path": "%(proj_path)s/local_settings.py",
     },
+    "upstreams": {
+        "local_path": "deploy/nginx_upstreams.conf",
+        "remote_path": "%(proj_path)s/nginx_upstreams.conf",
+    },
 }
 
+# Templates that live in a release directory and are uploaded to each
+# release as it's built, rather than to the live one.
+release_templates = ("settings", "gunicorn", "gunicorn_tiles", "upstreams")
+
+# Packages each release's virtualenv needs on top of the requirements.
+release_packages = ("gunicorn setproctitle south psycopg2 "
+                    "django-compressor python-memcached")
+
 
 ######################################
 # Context for virtualenv and project #
@@ -93,10 +139,11 @@ templates = {
 @contextmanager
 def virtualenv():
     """
-    Runs commands within the project's virtualenv.
+    Runs commands within the virtualenv of the release being worked on,
+    the live one by default.
     """
     with cd(env.venv_path):
-        with prefix("source %s/bin/activate" % env.venv_path):
+        with prefix("source %s/bin/activate" % env.env_path):
             yield
 
 
@@ -111,32 +158,22 @@ def project():
 
 
 @contextmanager
-def update_changed_requirements():
+def release(colour):
     """
-    Checks for changes in the requirements file across an update,
-    and gets new requirements if changes have occurred.
+    Runs commands within, and renders templates for, the release of the
+    given colour instead of the live one.
     """
-    reqs_path = os.path.join(env.proj_path, env.reqs_path)
-    get_reqs = lambda: run("cat %s" % reqs_path, show=False)
-    old_reqs = get_reqs() if env.reqs_path else ""
-    yield
-    if old_reqs:
-        new_reqs = get_reqs()
-        if old_reqs == new_reqs:
-            # Unpinned requirements should always be checked.
-            for req in new_reqs.split("\n"):
-                if req.startswith("-e"):
-                    if "@" not in req:
-                        # Editable requirement without pinned commit.
-                        break
-                elif req.strip() and not req.startswith("#"):
-                    if not set(">=<") & set(req):
-                        # PyPI requirement without version.
-                        break
-            else:
-                # All requirements are pinned.
-                return
-        pip("-r %s/%s" % (env.proj_path, env.reqs_path))
+    path = "%s/%s" % (env.releases_path, colour)
+    offset = COLOURS.index(colour) * env.release_port_offset
+    with settings(colour=colour,
+                  proj_dirname="releases/%s" % colour,
+                  proj_path=path,
+                  env_path="%s/env" % path,
+                  manage="LOCAL_SETTINGS=local_settings %s/env/bin/python %s/manage.py"
+                         % (path, path),
+                  gunicorn_port=env.gunicorn_port + offset,
+                  gunicorn_tiles_port=env.gunicorn_tiles_port + offset):
+        yield
 
 
 ###########################################
@@ -196,10 +233,36 @@ def get_templates():
     return injected
 
 
+# Content hashes of what was last uploaded or installed, by host.
+manifests = {}
+
+
+def manifest():
+    """
+    Returns the current host's manifest: the hash of each template, by
+    remote path, and of the requirements last installed. It's read
+    from the host once and kept.
+    """
+    if env.host_string not in manifests:
+        with hide("stdout"):
+            data = run("cat %s 2> /dev/null || true" % env.manifest_path, show=False)
+        manifests[env.host_string] = json.loads(data) if data.strip() else {}
+    return manifests[env.host_string]
+
+
+def update_manifest(key, digest):
+    """
+    Records the hash of a template or requirements on the host.
+    """
+    manifest()[key] = digest
+    data = json.dumps(manifest(), indent=2, sort_keys=True)
+    put(StringIO(data), env.manifest_path)
+
+
 def upload_template_and_reload(name):
     """
-    Uploads a template only if it has changed, and if so, reload a
-    related service.
+    Uploads a template only if it has changed since it was last
+    uploaded, and if so, reload a related service.
     """
     template = get_templates()[name]
     local_path = template["local_path"]
@@ -207,19 +270,17 @@ def upload_template_and_reload(name):
     reload_command = template.get("reload_command")
     owner = template.get("owner")
     mode = template.get("mode")
-    remote_data = ""
-    if exists(remote_path):
-        with hide("stdout"):
-            remote_data = sudo("cat %s" % remote_path, show=False)
     with open(local_path, "r") as f:
         local_data = f.read()
         # Escape all non-string-formatting-placeholder occurrences of '%':
         local_data = re.sub(r"%(?!\(\w+\)s)", "%%", local_data)
         if "%(db_pass)s" in local_data:
             env.db_pass = db_pass()
+        if "%(secret_key)s" in local_data and not (env.secret_key and env.nevercache_key):
+            abort("Set SECRET_KEY and NEVERCACHE_KEY in FABRIC to render %s" % local_path)
         local_data %= env
-    clean = lambda s: s.replace("\n", "").replace("\r", "").strip()
-    if clean(remote_data) == clean(local_data):
+    digest = sha1(local_data).hexdigest()
+    if manifest().get(remote_path) == digest:
         return
     upload_template(local_path, remote_path, env, use_sudo=True, backup=False)
     if owner:
@@ -228,6 +289,7 @@ def upload_template_and_reload(name):
         sudo("chmod %s %s" % (mode, remote_path))
     if reload_command:
         sudo(reload_command)
+    update_manifest(remote_path, digest)
 
 
 def db_pass():
@@ -256,6 +318,44 @@ def pip(packages):
         return sudo("pip install %s" % packages)
 
 
+def install_requirements():
+    """
+    Installs the project's requirements into the release's virtualenv if
+    they've changed since they were last installed there. They're
+    installed from a wheelhouse for their hash: ``WHEELHOUSE_URL`` if
+    given, otherwise one built on the host the first time that hash is
+    seen, and shared by both releases.
+    """
+    reqs_path = os.path.join(env.proj_path, env.reqs_path)
+    digest = run("sha1sum %s" % reqs_path, show=False).split()[0]
+    manifest_key = "requirements:%s" % env.env_path
+    if manifest().get(manifest_key) == digest:
+        return
+    if env.wheelhouse_url:
+        wheelhouse = "%s/%s/" % (env.wheelhouse_url.rstrip("/"), digest)
+    else:
+        wheelhouse = "%s/wheelhouse/%s" % (env.venv_path, digest)
+        if not exists(wheelhouse):
+            with virtualenv():
+                run("pip wheel -w %s.new -r %s && mv %s.new %s"
+                    % (wheelhouse, reqs_path, wheelhouse, wheelhouse))
+    pip("--no-index --find-links %s -r %s" % (wheelhouse, reqs_path))
+    update_manifest(manifest_key, digest)
+
+
+def build_release_env():
+    """
+    Creates the virtualenv of the release being worked on if it has
+    none yet, and brings its requirements up to date. Packages the live
+    release runs on are never touched.
+    """
+    if not exists(env.env_path):
+        run("virtualenv %s --distribute" % env.env_path)
+        pip(release_packages)
+    if env.reqs_path:
+        install_requirements()
+
+
 def postgres(command):
     """
     Runs the given command as the postgres user.
@@ -275,20 +375,83 @@ def psql(sql, show=True):
     return out
 
 
+def backup_path(kind, name):
+    """
+    Returns the remote path of a database dump or static snapshot, kept
+    under ``env.backup_path`` unless given as an absolute path.
+    """
+    return os.path.join(env.backup_path, kind, name)
+
+
+def skipped_tables():
+    """
+    Returns the tables listed in the ``env.backup_skip_tables`` manifest.
+    """
+    if not os.path.exists(env.backup_skip_tables):
+        return []
+    with open(env.backup_skip_tables) as f:
+        lines = [line.split("#")[0].strip() for line in f]
+    return [line for line in lines if line]
+
+
 @task
 def backup(filename):
     """
-    Backs up the database.
+    Backs up the database, dumping tables in parallel to a directory.
+    Tables in the skip manifest are left out entirely, so a restore
+    leaves them as they are.
     """
-    return postgres("pg_dump -Fc %s > %s" % (env.proj_name, filename))
+    path = backup_path("db", filename)
+    directory = os.path.dirname(path)
+    sudo("mkdir -p %s && chown postgres %s" % (directory, directory))
+    excludes = "".join(" -T '%s'" % table for table in skipped_tables())
+    # Dump aside and swap, so a failed dump keeps the last good one.
+    postgres("rm -rf %s.new" % path)
+    postgres("pg_dump -Fd -j %s -Z %s%s -f %s.new %s" % (
+        env.backup_jobs, env.backup_compression, excludes, path, env.proj_name))
+    return postgres("rm -rf %s && mv %s.new %s" % (path, path, path))
 
 
 @task
 def restore(filename):
     """
-    Restores the database.
+    Restores the database, loading tables in parallel.
+    """
+    return postgres("pg_restore -c -j %s -d %s %s" % (
+        env.backup_jobs, env.proj_name, backup_path("db", filename)))
+
+
+def rsync_media(source, destination, link_dest=None):
+    """
+    Mirrors one media directory into another, copying only files that
+    differ. With ``link_dest``, files unchanged from it are hard links
+    to it instead of copies.
+    """
+    options = " --link-dest=%s" % link_dest if link_dest else ""
+    return run("rsync -a --delete%s %s/ %s/" % (options, source, destination))
+
+
+@task
+def snapshot_media(name):
+    """
+    Snapshots the media directory shared by the releases. Only files
+    changed since the last snapshot are copied; the rest are hard links
+    to it.
+    """
+    path = backup_path("media", name)
+    run("mkdir -p %s && rm -rf %s.new" % (os.path.dirname(path), path))
+    link_dest = path if exists(path) else None
+    rsync_media(env.media_path, path + ".new", link_dest)
+    return run("rm -rf %s && mv %s.new %s" % (path, path, path))
+
+
+@task
+def restore_media(name):
+    """
+    Puts the media directory back as it was in a snapshot, copying only
+    files that differ.
     """
-    return postgres("pg_restore -c -d %s %s" % (env.proj_name, filename))
+    return rsync_media(backup_path("media", name), env.media_path)
 
 
 @task
@@ -296,7 +459,8 @@ def python(code, show=True):
     """
     Runs Python code in the project's virtual environment, with Django loaded.
     """
-    setup = "import os; os.environ[\'DJANGO_SETTINGS_MODULE\']=\'settings\';"
+    setup = ("import os; os.environ[\'DJANGO_SETTINGS_MODULE\']=\'settings\';"
+             "os.environ[\'LOCAL_SETTINGS\']=\'local_settings\';")
     full_code = 'python -c "%s%s"' % (setup, code.replace("`", "\\\`"))
     with project():
         result = run(full_code, show=False)
@@ -313,6 +477,14 @@ def static():
                   "print settings.STATIC_ROOT").split("\n")[-1]
 
 
+def media_root():
+    """
+    Returns the MEDIA_ROOT directory of the release being worked on.
+    """
+    return python("from django.conf import settings;"
+                  "print settings.MEDIA_ROOT").split("\n")[-1]
+
+
 @task
 def manage(command):
     """
@@ -353,18 +525,18 @@ def create():
     live host.
     """
 
-    # Create virtualenv
+    # Create the project directory; each release gets its own virtualenv.
     with cd(env.venv_home):
         if exists(env.proj_name):
-            prompt = raw_input("\nVirtualenv exists: %s\nWould you like "
+            prompt = raw_input("\nProject exists: %s\nWould you like "
                                "to replace it? (yes/no) " % env.proj_name)
             if prompt.lower() != "yes":
                 print "\nAborting!"
                 return False
             remove()
-        run("virtualenv %s --distribute" % env.proj_name)
-        vcs = "git" if env.git else "hg"
-        run("%s clone %s %s" % (vcs, env.repo_url, env.proj_path))
+        run("mkdir %s" % env.proj_name)
+    checkout_release("blue")
+    link_release("blue")
 
     # Create DB and DB user.
     pw = db_pass()
@@ -397,12 +569,12 @@ def create():
                 upload_template(key_local, key_file, use_sudo=True)
 
     # Set up project.
-    upload_template_and_reload("settings")
+    with release("blue"):
+        for name in release_templates:
+            upload_template_and_reload(name)
+        build_release_env()
+        link_media()
     with project():
-        if env.reqs_path:
-            pip("-r %s/%s" % (env.proj_path, env.reqs_path))
-        pip("gunicorn setproctitle south psycopg2 "
-            "django-compressor python-memcached")
         manage("createdb --noinput --nodata")
         python("from django.conf import settings;"
                "from django.contrib.sites.models import Site;"
@@ -444,29 +616,222 @@ def remove():
 # Deployment #
 ##############
 
+def live_colour():
+    """
+    Returns the colour of the live release, the one the project
+    symlink points to.
+    """
+    return run("readlink %s" % env.proj_path, show=False).rstrip("/").split("/")[-1]
+
+
+def other_colour(colour):
+    return COLOURS[1 - COLOURS.index(colour)]
+
+
+def checkout_release(colour):
+    """
+    Checks out the latest version of the project into the release of
+    the given colour.
+    """
+    with release(colour):
+        if exists(env.proj_path):
+            with cd(env.proj_path):
+                run("git fetch origin && git reset --hard origin/master" if env.git
+                    else "hg pull && hg up -C")
+        else:
+            vcs = "git" if env.git else "hg"
+            run("%s clone %s %s" % (vcs, env.repo_url, env.proj_path))
+
+
+def link_media():
+    """
+    Points the MEDIA_ROOT of the release being worked on at the media
+    directory shared by every release. Needs the release's requirements
+    installed, since MEDIA_ROOT is read from its settings.
+    """
+    path = media_root()
+    run("mkdir -p %s %s" % (env.media_path, os.path.dirname(path)))
+    return run("ln -sfn %s %s" % (env.media_path, path))
+
+
+def link_release(colour):
+    """
+    Atomically points the project symlink at the release of the given
+    colour.
+    """
+    link_args = (env.releases_path, colour, env.proj_path)
+    run("ln -sfn %s/%s %s.new" % link_args)
+    return run("mv -T %s.new %s" % (env.proj_path, env.proj_path))
+
+
+def adopt_release_layout():
+    """
+    Moves a project checked out before releases were kept side by side
+    into the blue release, and its media out to be shared. Gives the
+    live release its own virtualenv if it was built when the releases
+    shared one.
+    """
+    if not is_link(env.proj_path):
+        run("mkdir -p %s" % env.releases_path)
+        media = media_root()
+        if exists(media) and not exists(env.media_path):
+            run("mv %s %s" % (media, env.media_path))
+        run("mv %s %s/blue" % (env.proj_path, env.releases_path))
+        link_release("blue")
+        with release("blue"):
+            build_release_env()
+            link_media()
+            for name in release_templates:
+                upload_template_and_reload(name)
+    with release(live_colour()):
+        if not exists(env.env_path):
+            build_release_env()
+
+
+def build_release(colour):
+    """
+    Brings the release of the given colour up to the latest version:
+    code, requirements, templates, static files and database.
+    """
+    with release(colour):
+        checkout_release(colour)
+        build_release_env()
+        link_media()
+        for name in release_templates:
+            upload_template_and_reload(name)
+        with project():
+            manage("collectstatic -v 0 --noinput")
+            manage("syncdb --noinput")
+            manage("migrate --noinput")
+
+
+def start_release(colour):
+    """
+    Starts the gunicorns of the release of the given colour and warms
+    them up with the most requested pages and tiles.
+    """
+    sudo("supervisorctl restart %s_%s:*" % (env.proj_name, colour))
+    with release(colour):
+        manage("warm_release --site http://127.0.0.1:%s --tiles http://127.0.0.1:%s"
+               % (env.gunicorn_port, env.gunicorn_tiles_port))
+
+
+def switch_release(colour):
+    """
+    Sends new requests to the release of the given colour.
+    """
+    link_release(colour)
+    sudo("service nginx reload")
+
+
+def drain_release(colour):
+    """
+    Stops the release of the given colour once nginx has had time to
+    finish the requests it sent there.
+    """
+    run("sleep %s" % env.drain_seconds)
+    sudo("supervisorctl stop %s_%s:*" % (env.proj_name, colour))
+
+
 @task
 @log_call
 def restart():
     """
-    Restart gunicorn worker processes for the project.
+    Restart gunicorn processes for the live release. Deploys don't use
+    this, they start and warm up a new release alongside it instead.
     """
-    pid_path = "%s/gunicorn.pid" % env.proj_path
-    if exists(pid_path):
-        sudo("kill -HUP `cat %s`" % pid_path)
-    else:
-        start_args = (env.proj_name, env.proj_name)
-        sudo("supervisorctl start %s:gunicorn_%s" % start_args)
+    # The app is preloaded in the gunicorn masters (preload_app), so a
+    # HUP would only replace the workers, not load new code.
+    sudo("supervisorctl restart %s_%s:*" % (env.proj_name, live_colour()))
+
+
+class RolloutError(Exception):
+    pass
+
+
+def timed(func):
+    """
+    Wraps a per-host function so that instead of aborting the rollout it
+    returns whether it succeeded, how long it took and why it failed.
+    """
+    @wraps(func)
+    def timed_func(*args, **kwargs):
+        started = time.time()
+        try:
+            func(*args, **kwargs)
+        except BaseException as e:
+            return {"ok": False, "seconds": time.time() - started,
+                    "error": str(e) or e.__class__.__name__}
+        return {"ok": True, "seconds": time.time() - started, "error": ""}
+    return timed_func
+
+
+def health_check():
+    """
+    Requests each of ``env.health_check_urls`` from the current host's
+    nginx, failing on any error status.
+    """
+    for url in env.health_check_urls:
+        run('curl -kfsS -o /dev/null --max-time 30 -H "Host: %s" https://127.0.0.1%s'
+            % (env.live_host, url))
+
+
+def print_rollout(summary):
+    lines = ["%-30s %5s %9s  %s" % ("host", "batch", "seconds", "result")]
+    for host, batch, result in summary:
+        outcome = green("ok") if result["ok"] else red(result["error"])
+        lines.append("%-30s %5d %9.1f  %s" % (host, batch, result["seconds"], outcome))
+    _print("\n".join(lines))
+
+
+def rollout(func):
+    """
+    Runs a per-host function over all hosts in rolling batches. The
+    hosts in a batch run in parallel, up to ``DEPLOY_POOL_SIZE`` at a
+    time, and the first batch is a canary of ``DEPLOY_CANARY_HOSTS``
+    hosts. Each batch is health checked once it's done, and the rollout
+    halts after the first batch with a failure. Prints each host's time
+    and any failure at the end.
+    """
+    hosts = list(env.hosts)
+    canary = env.deploy_canary_hosts
+    size = env.deploy_batch_size
+    batches = [hosts[:canary]] + [hosts[i:i + size] for i in range(canary, len(hosts), size)]
+    # Hosts running in parallel can't prompt.
+    db_pass()
+    summary = []
+    failed = False
+    with settings(parallel=True, pool_size=env.deploy_pool_size,
+                  abort_exception=RolloutError):
+        for number, batch in enumerate(batch for batch in batches if batch):
+            results = execute(timed(func), hosts=batch)
+            passed = [host for host in batch if results[host]["ok"]]
+            if passed:
+                checks = execute(timed(health_check), hosts=passed)
+                for host in passed:
+                    if not checks[host]["ok"]:
+                        results[host] = dict(results[host], ok=False,
+                                             error="health check: " + checks[host]["error"])
+            summary.extend((host, number, results[host]) for host in batch)
+            if any(not result["ok"] for result in results.values()):
+                failed = True
+                break
+    print_rollout(summary)
+    if failed:
+        abort("Rollout halted after %d of %d hosts" % (len(summary), len(hosts)))
+    return summary
 
 
-@task
 @log_call
-def deploy():
+def deploy_host():
     """
-    Deploy latest version of the project.
+    Deploy latest version of the project to the current host.
     Check out the latest version of the project from version
-    control, install new requirements, sync and migrate the database,
-    collect any new static assets, and restart gunicorn's work
-    processes for the project.
+    control into the release that isn't live, install new requirements,
+    sync and migrate the database and collect any new static assets
+    there. Then start that release's gunicorns, warm them up, move
+    traffic over to them and stop the previous release once it has
+    finished its requests.
     """
     if not exists(env.venv_path):
         prompt = raw_input("\nVirtualenv doesn't exist: %s\nWould you like "
@@ -475,41 +840,59 @@ def deploy():
             print "\nAborting!"
             return False
         create()
+    adopt_release_layout()
     for name in get_templates():
-        upload_template_and_reload(name)
-    with project():
-        backup("last.db")
-        run("tar -cf last.tar %s" % static())
-        git = env.git
-        last_commit = "git rev-parse HEAD" if git else "hg id -i"
-        run("%s > last.commit" % last_commit)
-        with update_changed_requirements():
-            run("git pull origin master -f" if git else "hg pull && hg up -C")
-        manage("collectstatic -v 0 --noinput")
-        manage("syncdb --noinput")
-        manage("migrate --noinput")
-    restart()
+        if name not in release_templates:
+            upload_template_and_reload(name)
+    live = live_colour()
+    colour = other_colour(live)
+    backup("last.db")
+    snapshot_media("last.media")
+    build_release(colour)
+    start_release(colour)
+    switch_release(colour)
+    drain_release(live)
     return True
 
 
-@task
 @log_call
+def rollback_host():
+    """
+    Reverts project state on the current host to the last deploy.
+    When a deploy is performed, the previous release is kept, and the
+    database and media are backed up. Calling rollback restores the
+    database and media, then starts the previous release, still on its
+    own virtualenv, and moves traffic back to it the same way a deploy
+    does.
+    """
+    live = live_colour()
+    colour = other_colour(live)
+    restore_media("last.media")
+    restore("last.db")
+    start_release(colour)
+    switch_release(colour)
+    drain_release(live)
+
+
+@task
+@runs_once
+def deploy():
+    """
+    Deploy latest version of the project to every host, in rolling
+    parallel batches with a canary batch first. See ``deploy_host``
+    and ``rollout``.
+    """
+    return rollout(deploy_host)
+
+
+@task
+@runs_once
 def rollback():
     """
-    Reverts project state to the last deploy.
-    When a deploy is performed, the current state of the project is
-    backed up. This includes the last commit checked out, the database,
-    and all static files. Calling rollback will revert all of these to
-    their state prior to the last deploy.
+    Reverts every host to the last deploy, in rolling parallel batches.
+    See ``rollback_host`` and ``rollout``.
     """
-    with project():
-        with update_changed_requirements():
-            update = "git checkout" if env.git else "hg up -C"
-            run("%s `cat last.commit`" % update)
-        with cd(os.path.join(static(), "..")):
-            run("tar -xf %s" % os.path.join(env.proj_path, "last.tar"))
-        restore("last.db")
-    restart()
+    return rollout(rollback_host)
 
 
 @task
@@ -521,4 +904,4 @@ def all():
     """
     install()
     if create():
-        deploy()
+        deploy_host()
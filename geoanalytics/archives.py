@@ -0,0 +1,198 @@
+"""
+Checking zip archives while they are still being uploaded.
+
+A zip file starts with its members one after another, each behind a
+local header giving its name and compressed size. ``ZipScanner`` walks
+those headers over however much of the file has arrived so far, and
+picks up where it left off when more arrives, so a bad archive is
+rejected after its first few chunks instead of after the whole upload.
+Its state is a small dict that can be stored between requests.
+
+A member written with a trailing data descriptor doesn't give its size
+up front, so scanning stops there and the rest of the archive is only
+checked once the upload is complete. ZIP64 members give their sizes in
+an extra field instead of the header, and are scanned past the same
+way as any other.
+
+``inspect`` reads the shapefiles in a zip through OGR's ``/vsizip/``
+file system, without extracting anything to disk, and caches what it
+finds by ``archive_hash``.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import json
+import posixpath
+import struct
+import zipfile
+
+from django.conf import settings
+
+LOCAL_HEADER = b"PK\x03\x04"
+CENTRAL_HEADER = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+LOCAL_HEADER_FORMAT = b"<4s2B4HL2L2H"
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+DATA_DESCRIPTOR_FLAG = 0x08
+ZIP64_LIMIT = 0xffffffff
+ZIP64_EXTRA_ID = 0x0001
+SHAPEFILE_PARTS = (".shp", ".shx", ".dbf")
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def is_zip(name):
+    return name.lower().endswith(".zip")
+
+
+def check_member_name(name):
+    """
+    Refuse names that would land outside the directory the archive is
+    read or extracted into.
+    """
+    normalized = posixpath.normpath(name.replace("\\", "/"))
+    if normalized.startswith(("/", "../")) or normalized == ".." or ":" in normalized:
+        raise ArchiveError("Unsafe member name %r" % name)
+
+
+def zip64_compressed_size(extra):
+    """
+    The compressed size in the ZIP64 extra field of a local header, or
+    ``None`` if ``extra`` doesn't have one. Local headers give both the
+    uncompressed and compressed size there, in that order.
+    """
+    position = 0
+    while position + 4 <= len(extra):
+        record_id, length = struct.unpack(b"<2H", extra[position:position + 4])
+        if record_id == ZIP64_EXTRA_ID and length >= 16:
+            return struct.unpack(b"<2Q", extra[position + 4:position + 20])[1]
+        position += 4 + length
+    return None
+
+
+class ZipScanner(object):
+    def __init__(self, state=None):
+        self.state = state or {"position": 0, "members": [], "done": False}
+
+    def scan(self, f, available):
+        """
+        Read the local headers in ``f`` up to byte ``available``.
+        Returns the names of members found by this call and raises
+        ``ArchiveError`` if the data can't be a zip archive.
+        """
+        state = self.state
+        found = []
+        while not state["done"] and state["position"] + 4 <= available:
+            f.seek(state["position"])
+            signature = f.read(4)
+            if signature in (CENTRAL_HEADER, END_OF_CENTRAL_DIRECTORY):
+                state["done"] = True
+                break
+            if signature != LOCAL_HEADER:
+                raise ArchiveError("Not a zip archive, or a corrupt one, at byte %d"
+                                   % state["position"])
+            if state["position"] + LOCAL_HEADER_SIZE > available:
+                break
+            f.seek(state["position"])
+            header = struct.unpack(LOCAL_HEADER_FORMAT, f.read(LOCAL_HEADER_SIZE))
+            flags, compressed_size = header[3], header[8]
+            name_length, extra_length = header[10], header[11]
+            data_start = state["position"] + LOCAL_HEADER_SIZE + name_length + extra_length
+            if data_start > available:
+                break
+            name = f.read(name_length).decode("utf-8", "replace")
+            check_member_name(name)
+            state["members"].append(name)
+            found.append(name)
+            if ZIP64_LIMIT in (compressed_size, header[9]):
+                compressed_size = zip64_compressed_size(f.read(extra_length))
+                if compressed_size is None:
+                    raise ArchiveError("%s has no ZIP64 sizes" % name)
+            if flags & DATA_DESCRIPTOR_FLAG and not compressed_size:
+                state["done"] = True
+                break
+            state["position"] = data_start + compressed_size
+        return found
+
+
+def shapefile_layers(names):
+    """
+    The shapefiles among the member ``names`` of an archive, as a dict of
+    each one's base name to its members by extension (``.shp``, ``.shx``,
+    ``.dbf`` and ``.prj`` if there is one).
+    """
+    members = {}
+    for name in names:
+        base, extension = posixpath.splitext(name)
+        extension = extension.lower()
+        if extension in SHAPEFILE_PARTS + (".prj",):
+            members.setdefault(base, {})[extension] = name
+    layers = {}
+    for base, parts in members.items():
+        if ".shp" not in parts:
+            continue
+        missing = [extension for extension in SHAPEFILE_PARTS if extension not in parts]
+        if missing:
+            raise ArchiveError("%s has no %s" % (parts[".shp"], ", ".join(missing)))
+        layers[base] = parts
+    return layers
+
+
+def archive_hash(archive):
+    """
+    Identifies the contents of an open ``zipfile.ZipFile``. The central
+    directory has every member's name, size and CRC, so hashing it is as
+    good as hashing the archive and only reads its last few kilobytes.
+    """
+    digest = hashlib.sha1()
+    for info in sorted(archive.infolist(), key=lambda info: info.filename):
+        digest.update(("%s\0%d\0%d\0" % (info.filename, info.CRC, info.file_size)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _prj_wkt(archive, member):
+    """
+    OGC WKT of the ESRI WKT in a shapefile's ``.prj`` member.
+    """
+    from osgeo import osr
+
+    srs = osr.SpatialReference()
+    if srs.ImportFromESRI([archive.read(member).decode("latin-1")]):
+        return None
+    return srs.ExportToWkt()
+
+
+def _inspect_layer(path, parts, archive):
+    import fiona
+
+    with fiona.open("/" + parts[".shp"], vfs="zip://" + path) as collection:
+        return {
+            "schema": collection.schema,
+            "crs": collection.crs,
+            "crs_wkt": _prj_wkt(archive, parts[".prj"]) if ".prj" in parts else None,
+            "bounds": collection.bounds,
+            "count": len(collection),
+        }
+
+
+def inspect(path):
+    """
+    Schema, CRS, extent and feature count of each shapefile in the zip
+    archive at ``path``, keyed by the shapefile's path in the archive.
+    """
+    with zipfile.ZipFile(path) as archive:
+        key = "ga.archives.inspection:%s" % archive_hash(archive)
+        cached = settings.REDIS_CONNECTION.get(key)
+        if cached is not None:
+            return json.loads(cached)
+        names = archive.namelist()
+        for name in names:
+            check_member_name(name)
+        layers = dict((base, _inspect_layer(path, parts, archive))
+                      for base, parts in shapefile_layers(names).items())
+    data = json.dumps(layers)
+    settings.REDIS_CONNECTION.setex(key, data, settings.ARCHIVE_INSPECTION_SECONDS)
+    # The same plain data a cache hit returns.
+    return json.loads(data)
@@ -0,0 +1,83 @@
+"""
+Content-addressed files shared by every web and worker process through
+``BLOB_ROOT``, a private directory outside ``MEDIA_ROOT``. Used to pass
+large task payloads and results by reference instead of through Redis.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import os
+import tempfile
+from hashlib import sha1
+from time import time
+
+from django.conf import settings
+
+
+class BlobStore(object):
+    def __init__(self, subdirectory):
+        self.subdirectory = subdirectory
+
+    @property
+    def location(self):
+        return os.path.join(settings.BLOB_ROOT, self.subdirectory)
+
+    def path(self, name):
+        return os.path.join(self.location, name[:2], name)
+
+    def put(self, data, name=None):
+        """
+        Store ``data`` and return its name. Without a ``name`` the blob is
+        named by its content, so storing the same bytes twice yields the
+        same name and one file.
+        """
+        if name is None:
+            name = sha1(data).hexdigest()
+        path = self.path(name)
+        if os.path.exists(path):
+            os.utime(path, None)
+            return name
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write aside and rename, so readers never see a partial file.
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp, path)
+        return name
+
+    def open(self, name):
+        return open(self.path(name), "rb")
+
+    def get(self, name):
+        with self.open(name) as f:
+            return f.read()
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def purge(self, max_age):
+        """
+        Delete blobs not written or re-stored for ``max_age`` seconds.
+        Returns the number deleted.
+        """
+        cutoff = time() - max_age
+        deleted = 0
+        for directory, _, names in os.walk(self.location):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        deleted += 1
+                except OSError:
+                    pass
+        return deleted
@@ -0,0 +1,87 @@
+from __future__ import absolute_import, unicode_literals
+
+import math
+import random
+from hashlib import md5
+from time import sleep, time
+
+from django.core.cache import cache
+from django.conf import settings
+
+
+def _hashed_key(key):
+    """
+    Hash keys when talking directly to the cache API, to avoid keys
+    longer than the backend supports (eg memcache limit is 255). Keys
+    are namespaced so they never collide with Mezzanine's own packed
+    cache entries.
+    """
+    return "ga.page." + md5(key.encode("utf-8")).hexdigest()
+
+
+def _lock_key(key):
+    return _hashed_key(key) + ".lock"
+
+
+def cache_set(key, value, timeout=None, delta=0.0):
+    """
+    Wrapper for ``cache.set``. Stores the entry packed with its soft
+    expiry time and ``delta``, the number of seconds it took to build
+    the value. The entry is kept in cache for ``CACHE_STALE_SECONDS``
+    past its soft expiry so a stale copy can still be served while a
+    single request rebuilds it.
+    """
+    if timeout is None:
+        timeout = settings.CACHE_MIDDLEWARE_SECONDS
+    expires = time() + timeout
+    packed = (value, expires, delta)
+    return cache.set(_hashed_key(key), packed,
+                     timeout + settings.CACHE_STALE_SECONDS)
+
+
+def cache_get(key):
+    """
+    Wrapper for ``cache.get``. Returns a ``(value, fresh)`` pair where
+    ``value`` is ``None`` on a miss. An entry stops being fresh once its
+    soft expiry has passed, or earlier with a probability that grows as
+    expiry approaches and with the cost of rebuilding the entry
+    (the "XFetch" algorithm). Early expiration spreads refreshes out
+    across requests and workers instead of having them all miss at the
+    same instant.
+    """
+    packed = cache.get(_hashed_key(key))
+    if packed is None:
+        return None, False
+    value, expires, delta = packed
+    beta = settings.CACHE_EARLY_EXPIRY_BETA
+    # 1 - random() lies in (0, 1], so the log is always defined.
+    early = -delta * beta * math.log(1.0 - random.random())
+    return value, time() + early < expires
+
+
+def acquire_lock(key):
+    """
+    Try to become the single request rebuilding ``key``. ``cache.add``
+    is atomic in every shared backend, so exactly one caller wins until
+    the lock is released or ``CACHE_LOCK_SECONDS`` pass.
+    """
+    return cache.add(_lock_key(key), 1, settings.CACHE_LOCK_SECONDS)
+
+
+def release_lock(key):
+    cache.delete(_lock_key(key))
+
+
+def wait_for(key, interval=0.05):
+    """
+    Poll for ``key`` while another request holds its lock, for at most
+    ``CACHE_LOCK_WAIT_SECONDS``. Returns the value, or ``None`` if it
+    didn't show up in time.
+    """
+    deadline = time() + settings.CACHE_LOCK_WAIT_SECONDS
+    while time() < deadline:
+        sleep(interval)
+        value, _ = cache_get(key)
+        if value is not None:
+            return value
+    return None
@@ -5,9 +5,30 @@ import os
 from celery import Celery
 from django.conf import settings
 
+from geoanalytics import instrumentation, serialization
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'geoanalytics.settings')
 os.environ.setdefault('PYTHONPATH', '/home/docker/geoanalytics/geoanalytics')
 
+serialization.register()
+
 app = Celery('geoanalytics')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+if settings.TASK_STATS_ENABLED:
+    instrumentation.connect_task_stats()
+
+
+class QueueRouter(object):
+    """
+    Routes tasks without a queue of their own by name prefix, using
+    ``CELERY_TASK_QUEUE_PREFIXES``. Tasks that name a queue in their
+    decorator keep it, and anything unmatched goes to
+    ``CELERY_DEFAULT_QUEUE``.
+    """
+    def route_for_task(self, task, args=None, kwargs=None):
+        for prefix, queue in settings.CELERY_TASK_QUEUE_PREFIXES:
+            if task.startswith(prefix):
+                return {'queue': queue}
+        return None
@@ -0,0 +1,230 @@
+"""
+Long-running jobs as chains of short, checkpointed Celery tasks.
+
+``CELERYD_TASK_SOFT_TIME_LIMIT`` keeps ordinary tasks short. A job that
+needs longer subclasses ``ChunkedJob``, splitting its input with
+``chunks`` and handling one piece at a time with ``process``::
+
+    class Reproject(ChunkedJob):
+        queue = 'ingest'
+
+        def chunks(self, path, srs):
+            return [(path, srs, i) for i in range(band_count(path))]
+
+        def process(self, chunk, state):
+            return reproject_band(*chunk)
+
+        def assemble(self, results, path, srs):
+            return merge_bands(results)
+
+    job_id = start(Reproject, '/data/big.tif', 'EPSG:3857')
+
+Each chunk runs as its own ``run_chunk`` task with ``chunk_time_limit``
+and can spread across workers. Its result is kept in Redis as soon as
+it finishes, so a chunk that already completed is never redone when a
+job is resumed after a worker restart. A chord runs ``assemble`` once
+every chunk has finished. A chunk that can make partial progress calls
+``checkpoint`` and gets the saved state back in ``process`` when it is
+retried after running out of time.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+import uuid
+
+from celery import chord
+from django.conf import settings
+from django.utils.module_loading import import_by_path
+from kombu.serialization import dumps, loads
+
+from geoanalytics.celery import app
+
+
+class ChunkedJob(object):
+    queue = 'analytics'
+    chunk_time_limit = 300
+    assemble_time_limit = 300
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.index = None
+
+    def chunks(self, *args, **kwargs):
+        """
+        The pieces of work for the given job arguments, as a list of
+        serializable values.
+        """
+        raise NotImplementedError
+
+    def process(self, chunk, state):
+        """
+        Do one piece of work and return its result. ``state`` is whatever
+        was last passed to ``checkpoint`` for this chunk, or ``None``.
+        """
+        raise NotImplementedError
+
+    def assemble(self, results, *args, **kwargs):
+        """
+        Combine the results of every chunk, in chunk order.
+        """
+        return results
+
+    def checkpoint(self, state):
+        """
+        Save partial progress on the chunk being processed.
+        """
+        _redis().hset(_key(self.job_id, 'checkpoints'), self.index, _pack(state))
+
+
+def _redis():
+    return settings.REDIS_CONNECTION
+
+
+def _key(job_id, part=None):
+    key = 'ga.chunked:' + job_id
+    return key + ':' + part if part else key
+
+
+def _pack(value):
+    content_type, encoding, data = dumps(
+        value, serializer=app.conf.CELERY_RESULT_SERIALIZER)
+    if not isinstance(data, bytes):
+        data = data.encode(encoding)
+    header = json.dumps([content_type, encoding]).encode('utf-8')
+    return header + b'\n' + data
+
+
+def _unpack(packed):
+    header, data = packed.split(b'\n', 1)
+    content_type, encoding = json.loads(header)
+    return loads(data, content_type, encoding)
+
+
+def _job(job_id):
+    meta = _redis().hgetall(_key(job_id))
+    if not meta:
+        raise KeyError('No chunked job %s' % job_id)
+    job = import_by_path(meta[b'path'])(job_id)
+    args, kwargs = json.loads(meta[b'arguments'])
+    return job, int(meta[b'total']), args, kwargs
+
+
+def start(job_class, *args, **kwargs):
+    """
+    Split a job into chunks and dispatch them. ``job_class`` is a
+    ``ChunkedJob`` subclass or its dotted path; the job arguments must
+    be JSON serializable. Returns the job id.
+    """
+    if not isinstance(job_class, basestring):
+        job_class = '%s.%s' % (job_class.__module__, job_class.__name__)
+    job_id = uuid.uuid4().hex
+    job = import_by_path(job_class)(job_id)
+    chunks = list(job.chunks(*args, **kwargs))
+    db = _redis()
+    pipe = db.pipeline()
+    pipe.hmset(_key(job_id), {
+        'path': job_class,
+        'arguments': json.dumps([args, kwargs]),
+        'total': len(chunks),
+        'done': 0,
+        'state': 'running',
+    })
+    if chunks:
+        pipe.rpush(_key(job_id, 'chunks'), *[_pack(chunk) for chunk in chunks])
+    pipe.execute()
+    _expire(job_id)
+    _dispatch(job, range(len(chunks)))
+    return job_id
+
+
+def resume(job_id):
+    """
+    Dispatch again whatever chunks of a job haven't finished, e.g. after
+    a worker was lost. Finished chunks are not redone.
+    """
+    job, total, args, kwargs = _job(job_id)
+    done = set(int(i) for i in _redis().hkeys(_key(job_id, 'results')))
+    _redis().hset(_key(job_id), 'state', 'running')
+    _dispatch(job, [i for i in range(total) if i not in done])
+
+
+def _dispatch(job, indexes):
+    from geoanalytics.tasks import run_chunk, assemble_chunks
+
+    header = [
+        run_chunk.s(job.job_id, index).set(
+            queue=job.queue,
+            soft_time_limit=job.chunk_time_limit,
+            time_limit=job.chunk_time_limit + 30)
+        for index in indexes
+    ]
+    callback = assemble_chunks.si(job.job_id).set(
+        queue=job.queue,
+        soft_time_limit=job.assemble_time_limit,
+        time_limit=job.assemble_time_limit + 30)
+    if header:
+        chord(header)(callback)
+    else:
+        callback.delay()
+
+
+def _expire(job_id):
+    pipe = _redis().pipeline()
+    for part in (None, 'chunks', 'results', 'checkpoints'):
+        pipe.expire(_key(job_id, part), settings.CHUNKED_JOB_TTL)
+    pipe.execute()
+
+
+def process_chunk(job_id, index):
+    """
+    Body of ``run_chunk``: process one chunk unless it is already done.
+    """
+    db = _redis()
+    if db.hexists(_key(job_id, 'results'), index):
+        return
+    job, total, args, kwargs = _job(job_id)
+    chunk = _unpack(db.lindex(_key(job_id, 'chunks'), index))
+    state = db.hget(_key(job_id, 'checkpoints'), index)
+    if state is not None:
+        state = _unpack(state)
+    job.index = index
+    result = job.process(chunk, state)
+    # hsetnx, so a chunk delivered twice is only counted once.
+    if db.hsetnx(_key(job_id, 'results'), index, _pack(result)):
+        pipe = db.pipeline()
+        pipe.hdel(_key(job_id, 'checkpoints'), index)
+        pipe.hincrby(_key(job_id), 'done', 1)
+        pipe.execute()
+    _expire(job_id)
+
+
+def assemble_job(job_id):
+    """
+    Body of ``assemble_chunks``: combine every chunk result in order.
+    """
+    job, total, args, kwargs = _job(job_id)
+    packed = _redis().hgetall(_key(job_id, 'results'))
+    if len(packed) < total:
+        missing = total - len(packed)
+        _redis().hset(_key(job_id), 'state', 'incomplete')
+        raise RuntimeError('%d chunks of job %s have no result' % (missing, job_id))
+    results = [_unpack(packed[str(i).encode()]) for i in range(total)]
+    result = job.assemble(results, *args, **kwargs)
+    _redis().hset(_key(job_id), 'state', 'done')
+    return result
+
+
+def progress(job_id):
+    """
+    ``{'state': ..., 'total': n, 'done': m, 'fraction': m / n}`` for a job.
+    """
+    meta = _redis().hgetall(_key(job_id))
+    if not meta:
+        raise KeyError('No chunked job %s' % job_id)
+    total, done = int(meta[b'total']), int(meta[b'done'])
+    return {
+        'state': meta[b'state'].decode('utf-8'),
+        'total': total,
+        'done': done,
+        'fraction': float(done) / total if total else 1.0,
+    }
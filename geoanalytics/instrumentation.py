@@ -0,0 +1,315 @@
+"""
+In-process metrics with periodic flushes to Redis.
+
+A ``StatsCollector`` accumulates counters and latency histograms per
+name (a view, a task) in the worker that produced them, and adds them
+into a Redis hash per name and per ``STATS_WINDOW_SECONDS`` window every
+``STATS_FLUSH_SECONDS``. Reading merges the windows still within
+``STATS_RETENTION_SECONDS``, so every worker's numbers add up to a
+rolling view of the whole site. Whatever a worker has left is flushed
+when it exits, see ``flush_all``.
+
+Histograms use fixed millisecond buckets, so merging is just adding
+counts and percentiles are reported as a bucket's upper bound.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import resource
+import threading
+from bisect import bisect_left
+from time import time
+
+import redis
+from celery import signals
+from django.conf import settings
+
+from geoanalytics import serialization
+
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+           30000, 60000)
+
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += 1
+        self.sum += value
+
+
+def percentile(counts, p):
+    """
+    Upper bound of the bucket holding the ``p``th percentile of
+    ``counts``. Values past the last bucket report as ``None``.
+    """
+    total = sum(counts)
+    if not total:
+        return 0
+    threshold = total * p / 100.0
+    seen = 0
+    for i, count in enumerate(counts):
+        seen += count
+        if seen >= threshold:
+            return BUCKETS[i] if i < len(BUCKETS) else None
+    return None
+
+
+class StatsCollector(object):
+    """
+    Counters and histograms for one namespace ("requests", "tasks").
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._reset()
+        self._flushed = time()
+
+    def _reset(self):
+        self._counters = {}
+        self._histograms = {}
+
+    def _key(self, name, window):
+        return "ga.stats.%s:%s:%d" % (self.namespace, name, window)
+
+    def _names_key(self):
+        return "ga.stats.%s" % self.namespace
+
+    def record(self, name, counters=None, histograms=None):
+        """
+        Add ``counters`` (field -> increment) and ``histograms``
+        (field -> milliseconds) to ``name``.
+        """
+        with self._lock:
+            view_counters = self._counters.setdefault(name, {})
+            for field, value in (counters or {}).items():
+                view_counters[field] = view_counters.get(field, 0) + value
+            view_histograms = self._histograms.setdefault(name, {})
+            for field, value in (histograms or {}).items():
+                if field not in view_histograms:
+                    view_histograms[field] = Histogram()
+                view_histograms[field].add(value)
+        if time() - self._flushed > settings.STATS_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counters, histograms = self._counters, self._histograms
+            self._reset()
+            self._flushed = time()
+        if not counters and not histograms:
+            return
+        window = int(time() // settings.STATS_WINDOW_SECONDS)
+        window *= settings.STATS_WINDOW_SECONDS
+        pipe = settings.REDIS_CONNECTION.pipeline(transaction=False)
+        for name in set(counters) | set(histograms):
+            key = self._key(name, window)
+            pipe.sadd(self._names_key(), name)
+            for field, value in counters.get(name, {}).items():
+                pipe.hincrbyfloat(key, field, value)
+            for field, hist in histograms.get(name, {}).items():
+                pipe.hincrby(key, field + ":count", hist.total)
+                pipe.hincrbyfloat(key, field + ":sum", hist.sum)
+                for i, count in enumerate(hist.counts):
+                    if count:
+                        pipe.hincrby(key, "%s:%d" % (field, i), count)
+            pipe.expire(key, settings.STATS_RETENTION_SECONDS)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            # Stats are best effort; never fail a request over them.
+            pass
+
+    def read(self, seconds=None):
+        """
+        Merge the flushed windows of the last ``seconds`` (all retained
+        windows by default) into ``{name: {"counters": {...},
+        "histograms": {field: {"count", "mean", "p50", ...}}}}``.
+        """
+        seconds = seconds or settings.STATS_RETENTION_SECONDS
+        step = settings.STATS_WINDOW_SECONDS
+        now = int(time() // step) * step
+        windows = range(now - seconds + step, now + step, step)
+        db = settings.REDIS_CONNECTION
+        stats = {}
+        for name in sorted(db.smembers(self._names_key())):
+            if not isinstance(name, type("")):
+                name = name.decode("utf-8")
+            pipe = db.pipeline(transaction=False)
+            for window in windows:
+                pipe.hgetall(self._key(name, window))
+            merged = {}
+            for data in pipe.execute():
+                for field, value in data.items():
+                    merged[field] = merged.get(field, 0) + float(value)
+            if merged:
+                stats[name] = _summarize(merged)
+        return stats
+
+
+def _summarize(merged):
+    counters = {}
+    buckets = {}
+    for field, value in merged.items():
+        if not isinstance(field, type("")):
+            field = field.decode("utf-8")
+        if ":" not in field:
+            counters[field] = value
+            continue
+        hist, part = field.rsplit(":", 1)
+        entry = buckets.setdefault(hist, {
+            "counts": [0] * (len(BUCKETS) + 1), "count": 0, "sum": 0.0})
+        if part in ("count", "sum"):
+            entry[part] = value
+        else:
+            entry["counts"][int(part)] = int(value)
+    histograms = {}
+    for hist, entry in buckets.items():
+        summary = {
+            "count": int(entry["count"]),
+            "mean": entry["sum"] / entry["count"] if entry["count"] else 0,
+        }
+        for p in PERCENTILES:
+            summary["p%d" % p] = percentile(entry["counts"], p)
+        histograms[hist] = summary
+    return {"counters": counters, "histograms": histograms}
+
+
+request_stats = StatsCollector("requests")
+task_stats = StatsCollector("tasks")
+
+
+def flush_all(**kwargs):
+    """
+    Push what this process has recorded since its last flush. ``record``
+    only flushes once a later call finds the interval has passed, so
+    this runs as a worker exits; it takes signal arguments for celery.
+    """
+    request_stats.flush()
+    task_stats.flush()
+
+
+###################
+# Task statistics #
+###################
+
+def _sent_key(task_id):
+    return "ga.stats.sent:%s" % task_id
+
+
+def _on_task_published(sender=None, body=None, **kwargs):
+    # Runs right after the message was serialized, so the serializer
+    # still knows its size.
+    try:
+        settings.REDIS_CONNECTION.setex(
+            _sent_key(body["id"]),
+            "%f %d" % (time(), serialization.last_size()),
+            settings.TASK_STATS_SENT_SECONDS)
+    except redis.RedisError:
+        pass
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _on_task_prerun(task_id=None, task=None, **kwargs):
+    task.request._stats_started = time()
+    task.request._stats_peak_rss = _peak_rss_mb()
+    try:
+        pipe = settings.REDIS_CONNECTION.pipeline()
+        pipe.get(_sent_key(task_id))
+        pipe.delete(_sent_key(task_id))
+        task.request._stats_sent = pipe.execute()[0]
+    except redis.RedisError:
+        task.request._stats_sent = None
+
+
+def _on_task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = getattr(task.request, "_stats_started", None)
+    if started is None:
+        return
+    now = time()
+    peak_rss = _peak_rss_mb()
+    counters = {
+        "tasks": 1,
+        "rss_growth_mb": peak_rss - task.request._stats_peak_rss,
+    }
+    if state:
+        counters["state_" + state.lower()] = 1
+    histograms = {
+        "runtime_ms": (now - started) * 1000,
+        "peak_rss_mb": peak_rss,
+    }
+    if task.request._stats_sent:
+        sent, size = task.request._stats_sent.split()
+        # Measured from publishing, so this includes any countdown or eta.
+        histograms["queue_ms"] = max(0, started - float(sent)) * 1000
+        histograms["payload_kb"] = int(size) / 1024.0
+    task_stats.record(task.name, counters, histograms)
+
+
+def connect_task_stats():
+    """
+    Record per task name: time from publishing to start (``queue_ms``),
+    ``runtime_ms``, the worker's peak RSS, message size and final state.
+    """
+    signals.after_task_publish.connect(_on_task_published, weak=False)
+    signals.task_prerun.connect(_on_task_prerun, weak=False)
+    signals.task_postrun.connect(_on_task_postrun, weak=False)
+    signals.worker_process_shutdown.connect(flush_all, weak=False)
+    signals.worker_shutdown.connect(flush_all, weak=False)
+
+
+##########################
+# Redis call accounting #
+##########################
+
+_local = threading.local()
+
+
+def start_redis_accounting():
+    _local.redis = [0, 0.0]
+
+
+def stop_redis_accounting():
+    """
+    Stop counting and return ``(calls, seconds)`` since the last start.
+    """
+    calls, seconds = getattr(_local, "redis", None) or (0, 0.0)
+    _local.redis = None
+    return calls, seconds
+
+
+def _accounted(method):
+    def wrapper(self, *args, **kwargs):
+        counts = getattr(_local, "redis", None)
+        if counts is None:
+            return method(self, *args, **kwargs)
+        started = time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            counts[0] += 1
+            counts[1] += time() - started
+    wrapper._accounted = True
+    return wrapper
+
+
+def install_redis_accounting():
+    """
+    Wrap redis-py's command and pipeline execution so calls made while
+    accounting is started on the current thread are counted and timed.
+    Safe to call more than once.
+    """
+    for cls, attr in ((redis.StrictRedis, "execute_command"),
+                      (redis.client.BasePipeline, "execute")):
+        method = getattr(cls, attr)
+        if not getattr(method, "_accounted", False):
+            setattr(cls, attr, _accounted(method))
@@ -0,0 +1,30 @@
+"""
+Redis locks that only their holder can release.
+
+A lock is taken with ``SET key token NX EX seconds``, ``token`` being
+unique to the holder. It may expire while the holder is still at work
+and be taken by someone else, so ``release`` deletes it only if it
+still holds the holder's token.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import uuid
+
+RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def new_token():
+    return uuid.uuid4().hex
+
+
+def release(db, lock, token, client=None):
+    """
+    Delete ``lock`` if it still holds ``token``. Pass a pipeline as
+    ``client`` to queue the release on it.
+    """
+    return db.register_script(RELEASE_LOCK)(keys=[lock], args=[token], client=client)
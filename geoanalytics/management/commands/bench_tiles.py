@@ -0,0 +1,90 @@
+from __future__ import absolute_import, division
+
+import random
+import threading
+import time
+from optparse import make_option
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+from geoanalytics.tiles import tile_range
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Command(BaseCommand):
+    args = "<base url> [<base url> ...]"
+    help = ("Request random tiles of a layer from one or more servers "
+            "(e.g. the sync and the threaded gunicorn) with many concurrent "
+            "clients, and report requests per second and latency "
+            "percentiles for each.")
+    option_list = BaseCommand.option_list + (
+        make_option("--layer", dest="layer", help="Slug of the layer to request."),
+        make_option("--bbox", dest="bbox", default="-180,-85,180,85",
+                    help="west,south,east,north in degrees to pick tiles from."),
+        make_option("--zoom", dest="zoom", type="int", default=10),
+        make_option("--clients", dest="clients", type="int", default=50,
+                    help="Concurrent clients."),
+        make_option("--requests", dest="requests", type="int", default=2000,
+                    help="Requests per server."),
+        make_option("--seed", dest="seed", type="int", default=0,
+                    help="Random seed, so every server gets the same tiles."),
+    )
+
+    def handle(self, *urls, **options):
+        if not urls or not options["layer"]:
+            raise CommandError("Give --layer and at least one base URL.")
+        bbox = [float(v) for v in options["bbox"].split(",")]
+        minx, miny, maxx, maxy = tile_range(bbox, options["zoom"])
+        rng = random.Random(options["seed"])
+        paths = ["/tiles/%s/%d/%d/%d.png" % (options["layer"], options["zoom"],
+                                             rng.randint(minx, maxx),
+                                             rng.randint(miny, maxy))
+                 for _ in range(options["requests"])]
+
+        self.stdout.write("%-30s %8s %8s %8s %8s %8s" % (
+            "server", "req/s", "p50 ms", "p90 ms", "p99 ms", "errors"))
+        for url in urls:
+            self.stdout.write("%-30s %8.1f %8.1f %8.1f %8.1f %8d" % (
+                (url,) + self.run(url.rstrip("/"), paths, options["clients"])))
+
+    def run(self, url, paths, clients):
+        queue = list(paths)
+        lock = threading.Lock()
+        latencies = []
+        errors = [0]
+
+        def client():
+            session = requests.Session()
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    path = queue.pop()
+                started = time.time()
+                try:
+                    ok = session.get(url + path, timeout=60).status_code == 200
+                except requests.RequestException:
+                    ok = False
+                elapsed = (time.time() - started) * 1000
+                with lock:
+                    latencies.append(elapsed)
+                    if not ok:
+                        errors[0] += 1
+
+        started = time.time()
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        return (len(latencies) / elapsed,
+                _percentile(latencies, 50),
+                _percentile(latencies, 90),
+                _percentile(latencies, 99),
+                errors[0])
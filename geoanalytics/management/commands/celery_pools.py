@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+
+import os
+import signal
+import subprocess
+import sys
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = "[queue queue ...]"
+    help = ("Start one celery worker pool per queue in CELERY_WORKER_POOLS "
+            "(or just the queues given), each with its own concurrency and "
+            "prefetch settings. Stops them all if any one exits.")
+    option_list = BaseCommand.option_list + (
+        make_option("--loglevel", "-l", dest="loglevel", default="INFO"),
+    )
+
+    def handle(self, *queues, **options):
+        pools = settings.CELERY_WORKER_POOLS
+        queues = queues or sorted(pools)
+        unknown = set(queues) - set(pools)
+        if unknown:
+            raise CommandError("No worker pool for %s" % ", ".join(sorted(unknown)))
+
+        workers = []
+        for queue in queues:
+            pool = pools[queue]
+            command = [
+                "celery", "worker", "-A", "geoanalytics", "-E", "-Ofair",
+                "-Q", queue,
+                "-n", "%s.%%h" % queue,
+                "-c", str(pool["concurrency"]),
+                "-l", options["loglevel"],
+            ]
+            if pool.get("beat"):
+                command.append("--beat")
+            if "max_tasks_per_child" in pool:
+                command.append("--maxtasksperchild=%d" % pool["max_tasks_per_child"])
+            env = dict(os.environ)
+            env["CELERYD_PREFETCH_MULTIPLIER"] = str(pool["prefetch_multiplier"])
+            self.stdout.write("Starting %s pool: %s" % (queue, " ".join(command)))
+            workers.append(subprocess.Popen(command, env=env))
+
+        def stop(signum=signal.SIGTERM, frame=None):
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.send_signal(signum)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        try:
+            while all(worker.poll() is None for worker in workers):
+                time.sleep(1)
+        finally:
+            stop()
+            for worker in workers:
+                worker.wait()
+        sys.exit(max(worker.returncode for worker in workers))
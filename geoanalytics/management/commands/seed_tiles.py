@@ -0,0 +1,53 @@
+from __future__ import absolute_import
+
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from geoanalytics import chunked, seeding
+
+
+def _zooms(value):
+    first, _, last = value.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+class Command(BaseCommand):
+    args = "<layer slug>"
+    help = ("Render the tiles of a layer into the tile cache ahead of "
+            "time, on the seed workers.")
+    option_list = BaseCommand.option_list + (
+        make_option("--style", dest="style", default="",
+                    help="Style slug, the layer's default style if not given."),
+        make_option("--bbox", dest="bbox", default=None,
+                    help="west,south,east,north in degrees. Default: the world."),
+        make_option("--zooms", dest="zooms", default=None,
+                    help="Zoom levels, e.g. 0-12 or 14. Default: TILE_SEED_ZOOMS."),
+        make_option("--wait", action="store_true", dest="wait", default=False,
+                    help="Report progress until the job is done."),
+    )
+
+    def handle(self, layer=None, **options):
+        if not layer:
+            raise CommandError("Give the slug of the layer to seed.")
+        bbox = options["bbox"]
+        if bbox:
+            bbox = [float(v) for v in bbox.split(",")]
+            if len(bbox) != 4:
+                raise CommandError("--bbox takes west,south,east,north")
+        zooms = _zooms(options["zooms"]) if options["zooms"] else settings.TILE_SEED_ZOOMS
+
+        try:
+            job_id = seeding.seed(layer, options["style"], bbox, zooms)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write("Seeding %s as job %s" % (layer, job_id))
+
+        while options["wait"]:
+            progress = chunked.progress(job_id)
+            self.stdout.write("%(state)s: %(done)d of %(total)d metatiles" % progress)
+            if progress["state"] != "running":
+                break
+            time.sleep(5)
@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+
+import threading
+import time
+from optparse import make_option
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from geoanalytics.mappool import USAGE_KEY
+from geoanalytics.tiles import tile_cache
+
+
+def _tile_paths():
+    """
+    Low zoom tiles of the most used layers and styles.
+    """
+    paths = []
+    seen = set()
+    for entry in tile_cache.db.zrevrange(USAGE_KEY, 0, settings.WARMUP_TILE_LAYERS - 1):
+        layer, style = entry.decode("utf-8").split("\n")[:2]
+        if (layer, style) in seen:
+            continue
+        seen.add((layer, style))
+        query = "?style=%s" % style if style else ""
+        for z in settings.WARMUP_TILE_ZOOMS:
+            for x in range(2 ** z):
+                for y in range(2 ** z):
+                    paths.append("/tiles/%s/%d/%d/%d.png%s" % (layer, z, x, y, query))
+    return paths
+
+
+class Command(BaseCommand):
+    help = ("Wait for a newly started release's gunicorns to come up and "
+            "send them the most requested pages and tiles, so every worker "
+            "has warm caches before it takes live traffic. Fails if a "
+            "server doesn't come up or errors.")
+    option_list = BaseCommand.option_list + (
+        make_option("--site", dest="site", help="Base URL of the site gunicorn."),
+        make_option("--tiles", dest="tiles", help="Base URL of the tile gunicorn."),
+        make_option("--timeout", dest="timeout", type="int", default=120,
+                    help="Seconds to wait for each server to come up."),
+        make_option("--clients", dest="clients", type="int", default=16,
+                    help="Concurrent clients, enough to reach every worker."),
+        make_option("--rounds", dest="rounds", type="int", default=3,
+                    help="Times each URL is requested by each client."),
+    )
+
+    def handle(self, **options):
+        if not options["site"] or not options["tiles"]:
+            raise CommandError("Give the --site and --tiles base URLs.")
+        servers = ((options["site"].rstrip("/"), list(settings.WARMUP_URLS)),
+                   (options["tiles"].rstrip("/"), _tile_paths()))
+        for url, _ in servers:
+            self.wait(url, options["timeout"])
+        for url, paths in servers:
+            started = time.time()
+            count, errors = self.warm(url, paths, options["clients"], options["rounds"])
+            self.stdout.write("%s: %d requests in %.1fs" % (url, count, time.time() - started))
+            if errors:
+                raise CommandError("%s: %s" % (url, ", ".join(sorted(errors))))
+
+    def wait(self, url, timeout):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                requests.get(url + "/", timeout=timeout)
+                return
+            except requests.ConnectionError:
+                if time.time() > deadline:
+                    raise CommandError("%s didn't come up in %ds" % (url, timeout))
+                time.sleep(1)
+
+    def warm(self, url, paths, clients, rounds):
+        lock = threading.Lock()
+        count = [0]
+        errors = set()
+
+        def client():
+            session = requests.Session()
+            for _ in range(rounds):
+                for path in paths:
+                    try:
+                        status = session.get(url + path, timeout=60).status_code
+                    except requests.RequestException as e:
+                        status = e.__class__.__name__
+                    with lock:
+                        count[0] += 1
+                        # 503 is a style still compiling, 404 a private layer.
+                        if not isinstance(status, int) or (status >= 500 and status != 503):
+                            errors.add("%s %s" % (path, status))
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return count[0], errors
@@ -0,0 +1,149 @@
+"""
+A per-process pool of loaded ``mapnik.Map`` objects.
+
+Loading a map from XML sets up fonts, symbolizers and datasources, which
+can take longer than drawing a tile with it. Maps are kept after use,
+keyed by layer, style, tile cache version and size, and handed out again
+to the next render of the same layer::
+
+    with map_pool.checkout(layer, style, width, height) as m:
+        mapnik.render(m, image)
+
+A map is only ever used by one thread at a time. The pool keeps at most
+``MAP_POOL_SIZE`` idle maps and drops the least recently used ones
+beyond that. Maps of an older version of a layer are never handed out
+and age out the same way.
+
+Dropping maps rarely gives memory back to the OS, so once the process
+grows past ``MAP_POOL_MAX_RSS`` bytes the pool stops keeping maps and
+calls ``recycle``, which gunicorn's ``post_fork`` sets to retire the
+worker gracefully.
+
+Every map loaded is counted in ``WMS_CACHE_DB``, and ``warm`` preloads
+the most used ones, from gunicorn's ``post_fork``.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import mapnik
+from django.conf import settings
+
+from geoanalytics import styles
+from geoanalytics.tiles import tile_cache
+
+USAGE_KEY = "ga.mappool.usage"
+
+
+def load_map(layer, style, width, height):
+    """
+    A ``mapnik.Map`` for ``layer`` drawn with ``style``, given as slugs.
+    """
+    m = mapnik.Map(width, height)
+    mapnik.load_map_from_string(m, styles.mapnik_xml(layer, style))
+    return m
+
+
+def _rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf(str("SC_PAGE_SIZE"))
+
+
+class MapPool(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()  # key -> [Map, ...], least recently used first
+        self._size = 0
+        self.recycle = None
+        self._recycling = False
+
+    def _key(self, layer, style, width, height):
+        return layer, style, tile_cache.version(layer), width, height
+
+    def _take(self, key):
+        with self._lock:
+            maps = self._idle.pop(key, None)
+            if not maps:
+                return None
+            m = maps.pop()
+            self._size -= 1
+            if maps:
+                self._idle[key] = maps
+            return m
+
+    def _evict(self):
+        # Caller holds the lock.
+        key, maps = self._idle.popitem(last=False)
+        maps.pop(0)
+        self._size -= 1
+        if maps:
+            self._idle[key] = maps
+
+    def _over_rss(self):
+        # Caller holds the lock.
+        if _rss() <= settings.MAP_POOL_MAX_RSS:
+            return False
+        if not self._recycling and self.recycle is not None:
+            self._recycling = True
+            self.recycle()
+        return True
+
+    def _put(self, key, m):
+        with self._lock:
+            if self._over_rss():
+                return
+            while self._idle and self._size >= settings.MAP_POOL_SIZE:
+                self._evict()
+            if self._size >= settings.MAP_POOL_SIZE:
+                return
+            maps = self._idle.pop(key, [])
+            maps.append(m)
+            self._idle[key] = maps
+            self._size += 1
+
+    def _load(self, key):
+        layer, style, _, width, height = key
+        m = load_map(layer, style, width, height)
+        tile_cache.db.zincrby(USAGE_KEY, "%s\n%s\n%d\n%d" % (layer, style, width, height), 1)
+        return m
+
+    @contextmanager
+    def checkout(self, layer, style, width, height):
+        """
+        A map for the caller's exclusive use while in the ``with`` block.
+        """
+        key = self._key(layer, style, width, height)
+        m = self._take(key)
+        if m is None:
+            m = self._load(key)
+        yield m
+        # Not reached if the block raised: the map may be half changed.
+        self._put(key, m)
+
+    def warm(self, count=None):
+        """
+        Load the ``count`` most used maps, ``MAP_POOL_WARM_COUNT`` by
+        default. Layers whose styles aren't compiled yet are skipped.
+        """
+        if count is None:
+            count = settings.MAP_POOL_WARM_COUNT
+        for entry in tile_cache.db.zrevrange(USAGE_KEY, 0, count - 1):
+            layer, style, width, height = entry.decode("utf-8").split("\n")
+            width, height = int(width), int(height)
+            try:
+                m = load_map(layer, style, width, height)
+            except Exception:
+                # Deleted layers, styles not compiled yet and the like.
+                continue
+            self._put(self._key(layer, style, width, height), m)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+            self._size = 0
+
+
+map_pool = MapPool()
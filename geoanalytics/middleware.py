@@ -0,0 +1,243 @@
+from __future__ import absolute_import, unicode_literals
+
+import cProfile
+import os
+import random
+from time import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.urlresolvers import Resolver404, resolve
+from django.db import connection
+from django.http import HttpResponse
+from django.middleware.csrf import CsrfViewMiddleware, get_token
+from django.utils.cache import get_max_age
+from django.utils.module_loading import import_by_path
+
+from mezzanine.utils.cache import cache_installed, cache_key_prefix
+
+from geoanalytics import instrumentation, permissions
+from geoanalytics.cache import (cache_get, cache_set, acquire_lock,
+                                release_lock, wait_for)
+
+
+def _force_csrf_token(request):
+    # Same as Mezzanine's FetchFromCacheMiddleware: new sessions won't
+    # get a csrf token on a cached response unless we force one here.
+    csrf_mw_name = "django.middleware.csrf.CsrfViewMiddleware"
+    if csrf_mw_name in settings.MIDDLEWARE_CLASSES:
+        csrf_mw = CsrfViewMiddleware()
+        csrf_mw.process_view(request, lambda x: None, None, None)
+        get_token(request)
+
+
+class FetchPageCacheMiddleware(object):
+    """
+    Request phase of the stampede-protected page cache. Sits directly
+    before Mezzanine's ``FetchFromCacheMiddleware``, which still has to
+    be installed for ``nevercache`` and the other cache-aware parts of
+    Mezzanine to work.
+
+    A fresh entry is returned straight away. When the entry is missing,
+    expired, or picked for early expiration, only the request that wins
+    the per-key lock renders the page; every other request is served
+    the stale copy if there is one, or waits briefly for the winner.
+    """
+
+    def process_request(self, request):
+        if (not cache_installed() or request.method != "GET" or
+                request.user.is_authenticated()):
+            return None
+        cache_key = cache_key_prefix(request) + request.get_full_path()
+        value, fresh = cache_get(cache_key)
+        request._page_cache_status = "hit"
+        if value is None or not fresh:
+            request._page_cache_status = "stale"
+            if acquire_lock(cache_key):
+                request._page_cache_status = "miss"
+                request._page_cache_key = cache_key
+                request._page_cache_locked = True
+                request._page_cache_started = time()
+                return None
+            if value is None:
+                request._page_cache_status = "wait"
+                value = wait_for(cache_key)
+            if value is None:
+                # The rendering request is taking too long, render
+                # this one too rather than failing it.
+                request._page_cache_status = "miss"
+                request._page_cache_key = cache_key
+                request._page_cache_locked = False
+                request._page_cache_started = time()
+                return None
+        _force_csrf_token(request)
+        return HttpResponse(value)
+
+
+class UpdatePageCacheMiddleware(object):
+    """
+    Response phase of the stampede-protected page cache. Sits directly
+    after Mezzanine's ``UpdateCacheMiddleware`` so it runs first on the
+    way out: it stores the rendered page, releases the render lock, and
+    clears the update mark so Mezzanine doesn't store it a second time.
+    Mezzanine's middleware still performs the ``nevercache`` second
+    phase rendering.
+    """
+
+    def process_response(self, request, response):
+        cache_key = getattr(request, "_page_cache_key", None)
+        if cache_key is None:
+            return response
+        marked_for_update = getattr(request, "_update_cache", False)
+        request._update_cache = False
+        locked = request._page_cache_locked
+        anon = hasattr(request, "user") and not request.user.is_authenticated()
+        valid_status = response.status_code == 200
+        streaming = getattr(response, "streaming", False)
+        timeout = get_max_age(response)
+        if timeout is None:
+            timeout = settings.CACHE_MIDDLEWARE_SECONDS
+        if not (anon and valid_status and marked_for_update and timeout and
+                not streaming):
+            if locked:
+                release_lock(cache_key)
+            return response
+
+        def _cache_set(r):
+            delta = time() - request._page_cache_started
+            cache_set(cache_key, r.content, timeout, delta)
+            if locked:
+                release_lock(cache_key)
+
+        if callable(getattr(response, "render", None)):
+            response.add_post_render_callback(_cache_set)
+        else:
+            _cache_set(response)
+        return response
+
+
+class PagePermissionsViewableMiddleware(object):
+    """
+    Front for the page permission middleware named by
+    ``PAGE_PERMISSIONS_MIDDLEWARE`` (ga_resources' by default).
+
+    Requests under ``PAGE_PERMISSIONS_SKIP_PREFIXES`` (static files,
+    tiles) are never checked; the tile endpoints authorise layers on
+    their own. Other requests only reach the wrapped middleware when
+    ``geoanalytics.permissions`` has no memoized "allowed" decision for
+    the user and page.
+    """
+
+    def __init__(self):
+        self._wrapped = import_by_path(settings.PAGE_PERMISSIONS_MIDDLEWARE)()
+        self._skip_prefixes = tuple(settings.PAGE_PERMISSIONS_SKIP_PREFIXES)
+        for hook in ("process_response", "process_exception",
+                     "process_template_response"):
+            if hasattr(self._wrapped, hook):
+                setattr(self, hook, getattr(self._wrapped, hook))
+
+    def _check(self, hook, request, *args):
+        check = getattr(self._wrapped, hook, None)
+        if check is None:
+            return None
+        key = permissions.permission_key(request, hook)
+        if permissions.is_allowed(request, key):
+            return None
+        response = check(request, *args)
+        if response is None:
+            permissions.remember(request, key)
+        return response
+
+    def process_request(self, request):
+        if request.path.startswith(self._skip_prefixes):
+            request._skip_page_permissions = True
+            return None
+        return self._check("process_request", request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(request, "_skip_page_permissions", False):
+            return None
+        return self._check("process_view", request, view_func, view_args,
+                           view_kwargs)
+
+
+def _view_name(view_func):
+    return "%s.%s" % (view_func.__module__,
+                      getattr(view_func, "__name__", view_func.__class__.__name__))
+
+
+def _resolve_view_name(request):
+    # For responses returned before process_view, such as page cache
+    # hits, so they are counted against the view they stand in for.
+    try:
+        match = resolve(request.path_info, getattr(request, "urlconf", None))
+    except Resolver404:
+        return "(no view)"
+    return _view_name(match.func)
+
+
+class RequestStatsMiddleware(object):
+    """
+    Records wall time, database queries, Redis calls and page cache
+    outcome per view into ``geoanalytics.instrumentation.request_stats``.
+    Goes first in ``MIDDLEWARE_CLASSES`` so the timings include the
+    rest of the middleware.
+
+    A ``PROFILE_SAMPLE_RATE`` fraction of requests also runs under
+    cProfile; the profile is written to ``PROFILE_DIR`` when the request
+    took longer than ``PROFILE_SLOW_SECONDS``.
+    """
+
+    def __init__(self):
+        if not settings.REQUEST_STATS_ENABLED:
+            raise MiddlewareNotUsed
+        instrumentation.install_redis_accounting()
+
+    def process_request(self, request):
+        request._stats_started = time()
+        request._stats_debug_cursor = connection.use_debug_cursor
+        request._stats_queries = len(connection.queries)
+        connection.use_debug_cursor = True
+        instrumentation.start_redis_accounting()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._stats_view = _view_name(view_func)
+        if random.random() < settings.PROFILE_SAMPLE_RATE:
+            request._stats_profiler = cProfile.Profile()
+            request._stats_profiler.enable()
+
+    def process_response(self, request, response):
+        started = getattr(request, "_stats_started", None)
+        if started is None:
+            return response
+        profiler = getattr(request, "_stats_profiler", None)
+        if profiler is not None:
+            profiler.disable()
+        wall = time() - started
+        redis_calls, redis_time = instrumentation.stop_redis_accounting()
+        queries = connection.queries[request._stats_queries:]
+        connection.use_debug_cursor = request._stats_debug_cursor
+        view = getattr(request, "_stats_view", None) or _resolve_view_name(request)
+
+        counters = {
+            "requests": 1,
+            "db_queries": len(queries),
+            "redis_calls": redis_calls,
+        }
+        cache_status = getattr(request, "_page_cache_status", None)
+        if cache_status:
+            counters["cache_" + cache_status] = 1
+        if response.status_code >= 500:
+            counters["errors"] = 1
+        instrumentation.request_stats.record(view, counters, {
+            "wall_ms": wall * 1000,
+            "db_ms": sum(float(q["time"]) for q in queries) * 1000,
+            "redis_ms": redis_time * 1000,
+        })
+
+        if profiler is not None and wall > settings.PROFILE_SLOW_SECONDS:
+            if not os.path.isdir(settings.PROFILE_DIR):
+                os.makedirs(settings.PROFILE_DIR)
+            filename = "%s-%d.prof" % (view, started * 1000)
+            profiler.dump_stats(os.path.join(settings.PROFILE_DIR, filename))
+        return response
@@ -0,0 +1,54 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from ga_resources.models import DataResource, RenderedLayer, Style
+
+# Imported for its signal receivers, so every process that loads the
+# models, workers and management commands included, keeps the
+# permission memo up to date.
+from geoanalytics import permissions  # noqa
+from geoanalytics.tiles import tile_cache
+
+
+def layers_changed(layers):
+    """
+    Drop the cached tiles of ``layers``, queue their styles to be
+    compiled and queue them to be seeded again at
+    ``TILE_SEED_ON_PUBLISH_ZOOMS``.
+    """
+    from geoanalytics.tasks import compile_style, seed_layer
+
+    # Delayed so the tasks see the committed changes.
+    delay = settings.PUBLISH_TASK_DELAY
+    for layer in dict((layer.slug, layer) for layer in layers).values():
+        tile_cache.invalidate(layer.slug)
+        for style in [''] + [style.slug for style in layer.styles.all()]:
+            compile_style.apply_async((layer.slug, style), countdown=delay)
+        if settings.TILE_SEED_ON_PUBLISH_ZOOMS:
+            seed_layer.apply_async(
+                (layer.slug,), {'zooms': list(settings.TILE_SEED_ON_PUBLISH_ZOOMS)},
+                countdown=delay)
+
+
+@receiver(post_save, sender=RenderedLayer)
+def rendered_layer_changed(sender, instance, **kwargs):
+    layers_changed([instance])
+
+
+@receiver(post_delete, sender=RenderedLayer)
+def rendered_layer_deleted(sender, instance, **kwargs):
+    tile_cache.invalidate(instance.slug)
+
+
+@receiver(post_save, sender=Style)
+def style_changed(sender, instance, **kwargs):
+    layers_changed(list(RenderedLayer.objects.filter(default_style=instance)) +
+                   list(RenderedLayer.objects.filter(styles=instance)))
+
+
+@receiver(post_save, sender=DataResource)
+def data_resource_changed(sender, instance, **kwargs):
+    layers_changed(RenderedLayer.objects.filter(data_resource=instance))
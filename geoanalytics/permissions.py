@@ -0,0 +1,192 @@
+"""
+Memoized page permission decisions.
+
+Every worker keeps a small memo of ``(user, page) -> allowed`` entries
+that live for ``PERMISSIONS_MEMO_SECONDS``. The memo is tagged with a
+version number kept in ``PERMISSIONS_DB``; anything that changes who can
+see what calls ``invalidate_permissions``, which bumps the version and
+so empties the memo of every worker within
+``PERMISSIONS_VERSION_CHECK_SECONDS``. Decisions are also kept on the
+request itself so repeated checks while serving it are free.
+
+Only positive decisions are remembered. A denial is rare and is always
+handed back to the real permission check to build its response.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import copy
+from time import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from mezzanine.pages.models import Page
+
+VERSION_KEY = "ga.permissions.version"
+
+# User fields that change what a user may see.
+USER_FLAGS = ("is_active", "is_staff", "is_superuser")
+
+
+class PermissionMemo(object):
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._version = None
+        self._version_checked = 0
+
+    def version(self):
+        now = time()
+        if now - self._version_checked > settings.PERMISSIONS_VERSION_CHECK_SECONDS:
+            version = settings.PERMISSIONS_DB.get(VERSION_KEY)
+            if version != self._version:
+                self._entries = {}
+                self._version = version
+            self._version_checked = now
+        return self._version
+
+    def get(self, key):
+        version = self.version()
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        expires, entry_version = entry
+        return expires > time() and entry_version == version
+
+    def set(self, key):
+        if len(self._entries) >= self.max_entries:
+            self._entries = {}
+        expires = time() + settings.PERMISSIONS_MEMO_SECONDS
+        self._entries[key] = (expires, self.version())
+
+    def clear(self):
+        self._entries = {}
+        self._version_checked = 0
+
+
+memo = PermissionMemo()
+
+
+def _memoizable(request):
+    # Only reads are memoized; a POST may well be checked differently.
+    return request.method in ("GET", "HEAD")
+
+
+def user_key(request, *extra):
+    """
+    Memo key for a decision that depends on the user but not the path,
+    such as access to a layer whose tiles have many paths.
+    """
+    user = getattr(request, "user", None)
+    user_id = user.pk if user is not None and user.is_authenticated() else None
+    return (user_id,) + extra
+
+
+def permission_key(request, *extra):
+    user_id, = user_key(request)
+    return (user_id, request.path) + extra
+
+
+def _request_memo(request):
+    if not hasattr(request, "_page_permissions"):
+        request._page_permissions = {}
+    return request._page_permissions
+
+
+def is_allowed(request, key):
+    """
+    True if ``key`` is known to be allowed for this request, either from
+    earlier in the request or from this worker's memo.
+    """
+    if not _memoizable(request):
+        return False
+    request_memo = _request_memo(request)
+    if key in request_memo:
+        return True
+    if memo.get(key):
+        request_memo[key] = True
+        return True
+    return False
+
+
+def remember(request, key):
+    if not _memoizable(request):
+        return
+    _request_memo(request)[key] = True
+    memo.set(key)
+
+
+def viewable_page(request, model, slug):
+    """
+    The ``model`` page (a Mezzanine ``Page`` subclass) with ``slug`` if
+    ``request`` may see it, else ``None``, decided as the page permission
+    middleware decides it for the page's own URL: the page has to be
+    published for the user, a ``login_required`` page needs a logged in
+    user, and a page with ``can_view`` (ga_resources' owner, group and
+    public permissions) has to allow it.
+    """
+    try:
+        page = model.objects.published(for_user=request.user).get(slug=slug)
+    except model.DoesNotExist:
+        return None
+    if page.login_required and not request.user.is_authenticated():
+        return None
+    can_view = getattr(page, "can_view", None)
+    if can_view is not None and not can_view(request):
+        return None
+    return page
+
+
+def anonymous_request(request):
+    """
+    A copy of ``request`` as a visitor who isn't logged in would make it,
+    to ask whether a page is public.
+    """
+    anonymous = copy.copy(request)
+    anonymous.user = AnonymousUser()
+    return anonymous
+
+
+def invalidate_permissions():
+    """
+    Forget every memoized decision, in this worker and all others.
+    """
+    settings.PERMISSIONS_DB.incr(VERSION_KEY)
+    memo.clear()
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def page_changed(sender, instance, **kwargs):
+    if isinstance(instance, Page):
+        invalidate_permissions()
+
+
+def _user_flags(user):
+    return tuple(getattr(user, flag) for flag in USER_FLAGS)
+
+
+@receiver(post_init, sender=User)
+def user_loaded(sender, instance, **kwargs):
+    instance._permission_flags = _user_flags(instance)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, **kwargs):
+    # Every login saves the user, so only a change to USER_FLAGS counts.
+    flags = _user_flags(instance)
+    if not created and flags != instance._permission_flags:
+        invalidate_permissions()
+    instance._permission_flags = flags
+
+
+@receiver(m2m_changed)
+def relations_changed(sender, instance, **kwargs):
+    # Page viewer/editor groups, a user's groups and permissions, or a
+    # group's permissions.
+    if (isinstance(instance, Page) or
+            sender in (User.groups.through, User.user_permissions.through,
+                       Group.permissions.through)):
+        invalidate_permissions()
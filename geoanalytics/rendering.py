@@ -0,0 +1,93 @@
+"""
+Tile rendering with mapnik.
+
+Tiles are rendered a metatile at a time: one ``TILE_METATILE_SIZE``
+square block of tiles is drawn in a single pass and sliced up, so map
+setup, style parsing and the datasource query are paid once per block
+instead of once per tile. Maps come from the per-process
+``geoanalytics.mappool``. All tiles of a metatile are stored in one
+transaction.
+
+``tile`` is what the tile view calls: it answers from the tile cache
+and renders the tile's metatile on a miss. Concurrent misses on the same
+metatile, in any thread or worker, wait for a single render through
+``geoanalytics.singleflight`` instead of each drawing it.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import mapnik
+from django.conf import settings
+
+from geoanalytics.mappool import map_pool
+from geoanalytics.singleflight import request_key, single_flight
+from geoanalytics.tiles import (
+    MERCATOR_SRS, TILE_SIZE, metatile_tiles, tile_bbox, tile_cache)
+
+
+def metatile_span(z):
+    # A zoom level may have fewer tiles per side than a metatile.
+    return min(settings.TILE_METATILE_SIZE, 2 ** z)
+
+
+def metatile_for(z, x, y):
+    span = metatile_span(z)
+    return z, x // span, y // span
+
+
+def render_metatile(layer, style, z, mx, my):
+    """
+    Render a metatile in one pass and return ``{(z, x, y): png}`` for
+    each of its tiles.
+    """
+    span = metatile_span(z)
+    size = span * TILE_SIZE
+    image = mapnik.Image(size, size)
+    with map_pool.checkout(layer, style, size, size) as m:
+        # Draw past the edges so labels and symbols crossing a metatile
+        # boundary match up with the neighbouring metatile.
+        m.buffer_size = settings.TILE_METATILE_BUFFER
+        m.zoom_to_box(mapnik.Box2d(*tile_bbox(z, mx * span, my * span, span)))
+        mapnik.render(m, image)
+
+    tiles = {}
+    for z, x, y in metatile_tiles(z, mx, my, span):
+        view = image.view((x - mx * span) * TILE_SIZE, (y - my * span) * TILE_SIZE,
+                          TILE_SIZE, TILE_SIZE)
+        tiles[z, x, y] = view.tostring(str("png256"))
+    return tiles
+
+
+def metatile(layer, style, z, mx, my):
+    """
+    Render a metatile into the tile cache and return its tiles.
+    Concurrent calls for the same metatile share a single render.
+    """
+    span = metatile_span(z)
+    tiles = metatile_tiles(z, mx, my, span)
+
+    def render():
+        # Read before rendering: if the layer is published mid-render,
+        # these tiles are stored under the old version, not the new one.
+        version = tile_cache.version(layer)
+        rendered = render_metatile(layer, style, z, mx, my)
+        tile_cache.set_many(layer, style, rendered, version)
+        return rendered
+
+    def fetch():
+        cached = tile_cache.get_many(layer, style, tiles)
+        return None if None in cached else dict(zip(tiles, cached))
+
+    key = request_key("tiles", layer=layer, style=style, srs=MERCATOR_SRS,
+                      bbox=tile_bbox(z, mx * span, my * span, span),
+                      size=span * TILE_SIZE)
+    return single_flight.do(key, render, fetch)
+
+
+def tile(layer, style, z, x, y):
+    """
+    A tile as PNG, from the cache or rendered with its metatile.
+    """
+    data = tile_cache.get(layer, style, z, x, y)
+    if data is None:
+        data = metatile(layer, style, *metatile_for(z, x, y))[z, x, y]
+    return data
@@ -0,0 +1,133 @@
+"""
+Celery result backend that keeps Redis small.
+
+Results go to their own Redis database, expire after
+``CELERY_TASK_RESULT_EXPIRES`` and are zlib compressed once they pass
+``CELERY_RESULT_COMPRESS_BYTES``. A result larger than
+``CELERY_RESULT_DISK_BYTES`` is written compressed to a ``BlobStore``
+under ``BLOB_ROOT``, and Redis holds only the task's status and a
+reference to the file. Enable it with::
+
+    CELERY_RESULT_BACKEND = 'geoanalytics.results:ResultStore+redis://host:6379/1'
+
+``AsyncResult.get`` works as usual. Callers that don't want a large
+result in memory at once use ``open_result`` or ``iter_result``.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import io
+import zlib
+
+from celery.backends.redis import RedisBackend
+from django.conf import settings
+
+from geoanalytics import serialization
+from geoanalytics.blobs import BlobStore
+
+RAW = b'r'
+COMPRESSED = b'z'
+ON_DISK = b'd'
+
+CHUNK_SIZE = 64 * 1024
+
+results = BlobStore('task_results')
+
+
+class _DecompressingReader(object):
+    """
+    Read-only file object over a zlib compressed file.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            data = self.f.read(CHUNK_SIZE)
+            if not data:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(data)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ResultStore(RedisBackend):
+    def encode(self, meta):
+        data = serialization.pack(meta)
+        if len(data) > settings.CELERY_RESULT_DISK_BYTES and 'result' in meta:
+            result = serialization.pack(meta['result'])
+            meta = dict(meta, result=None,
+                        result_blob=results.put(zlib.compress(result)),
+                        result_size=len(result))
+            return ON_DISK + serialization.pack(meta)
+        if len(data) > settings.CELERY_RESULT_COMPRESS_BYTES:
+            return COMPRESSED + zlib.compress(data)
+        return RAW + data
+
+    def decode(self, payload):
+        kind, data = payload[:1], payload[1:]
+        if kind == COMPRESSED:
+            data = zlib.decompress(data)
+        meta = serialization.unpack(data)
+        if kind == ON_DISK:
+            with self._open_blob(meta) as f:
+                meta['result'] = serialization.unpack(f.read())
+        return meta
+
+    def _open_blob(self, meta):
+        return _DecompressingReader(results.open(meta['result_blob']))
+
+    def open_result(self, task_id):
+        """
+        File object over the packed result of a task, decompressed as it
+        is read. Raises ``KeyError`` if there is no result.
+        """
+        payload = self.get(self.get_key_for_task(task_id))
+        if payload is None:
+            raise KeyError('No result for task %s' % task_id)
+        if payload[:1] == ON_DISK:
+            return self._open_blob(serialization.unpack(payload[1:]))
+        return io.BytesIO(serialization.pack(self.decode(payload)['result']))
+
+
+def _backend():
+    from geoanalytics.celery import app
+    return app.backend
+
+
+def open_result(task_id):
+    """
+    ``ResultStore.open_result`` on the configured backend.
+    """
+    return _backend().open_result(task_id)
+
+
+def iter_result(task_id):
+    """
+    Yield the items of a task result that is a list one at a time,
+    without unpacking the whole list.
+    """
+    with open_result(task_id) as f:
+        unpacker = serialization.unpacker(f)
+        for _ in range(unpacker.read_array_header()):
+            yield unpacker.unpack()
+
+
+def purge(max_age):
+    """
+    Delete result files whose Redis entries have expired.
+    """
+    return results.purge(max_age)
@@ -0,0 +1,76 @@
+"""
+Pre-rendering tiles into the tile cache.
+
+``seed`` starts a ``geoanalytics.chunked`` job on the ``seed`` queue
+with one chunk per metatile (a ``TILE_METATILE_SIZE`` square block of
+tiles) over a bounding box and range of zoom levels, so the work spreads
+over the seed workers and its progress can be followed with
+``chunked.progress``. Metatiles that are already cached are skipped.
+
+Seeding yields to live rendering: after each render a worker pauses for
+``TILE_SEED_PAUSE_RATIO`` times as long as the render took, and while
+the machine's load average per CPU is above ``TILE_SEED_MAX_LOAD`` it
+waits, for at most ``TILE_SEED_MAX_WAIT_SECONDS`` per metatile.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import multiprocessing
+import os
+from time import sleep, time
+
+from django.conf import settings
+
+from geoanalytics import chunked, rendering, styles
+from geoanalytics.chunked import ChunkedJob
+from geoanalytics.tiles import metatile_tiles, metatiles, tile_cache
+
+WORLD = (-180.0, -85.0511287798, 180.0, 85.0511287798)
+
+
+def _throttle():
+    limit = settings.TILE_SEED_MAX_LOAD * multiprocessing.cpu_count()
+    deadline = time() + settings.TILE_SEED_MAX_WAIT_SECONDS
+    while os.getloadavg()[0] > limit and time() < deadline:
+        sleep(1)
+
+
+class SeedTiles(ChunkedJob):
+    queue = 'seed'
+
+    def chunks(self, layer, style, bbox, zooms):
+        chunks = [(layer, style, z, mx, my) for z, mx, my
+                  in metatiles(bbox, zooms, settings.TILE_METATILE_SIZE)]
+        if len(chunks) > settings.TILE_SEED_MAX_METATILES:
+            raise ValueError('Seeding %s would render %d metatiles, more than '
+                             'TILE_SEED_MAX_METATILES' % (layer, len(chunks)))
+        return chunks
+
+    def process(self, chunk, state):
+        layer, style, z, mx, my = chunk
+        tiles = metatile_tiles(z, mx, my, rendering.metatile_span(z))
+        missing = tile_cache.missing(layer, style, tiles)
+        if not missing:
+            return 0
+        _throttle()
+        started = time()
+        try:
+            rendering.metatile(layer, style, z, mx, my)
+        except styles.StyleNotReady:
+            styles.compile_style(layer, style)
+            rendering.metatile(layer, style, z, mx, my)
+        sleep((time() - started) * settings.TILE_SEED_PAUSE_RATIO)
+        return len(missing)
+
+    def assemble(self, results, layer, style, bbox, zooms):
+        return {'metatiles': len(results), 'rendered': sum(results)}
+
+
+def seed(layer, style='', bbox=None, zooms=None):
+    """
+    Start seeding ``layer`` (a slug) with ``style`` over a lon/lat
+    ``bbox``, the whole world by default, at each zoom in ``zooms``,
+    ``TILE_SEED_ZOOMS`` by default. Returns the job id.
+    """
+    if zooms is None:
+        zooms = settings.TILE_SEED_ZOOMS
+    return chunked.start(SeedTiles, layer, style, list(bbox or WORLD), list(zooms))
@@ -0,0 +1,130 @@
+"""
+msgpack serializer for Celery messages and results.
+
+On top of plain msgpack it packs numpy arrays as raw buffers (unpacked
+into writable arrays of their own; arrays of objects are refused),
+Shapely geometries as WKB and datetimes as ISO strings, so analytics
+tasks can pass them without pickle. An encoded message larger than
+``CELERY_PAYLOAD_OFFLOAD_BYTES`` is written to a ``BlobStore`` under
+``BLOB_ROOT`` and only a reference to it goes through Redis.
+
+``register`` makes the serializer available to kombu as
+``"geoanalytics"``. ``pack`` and ``unpack`` are the same encoding without
+the offloading.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import struct
+import threading
+from datetime import date, datetime
+
+import msgpack
+from dateutil.parser import parse as parse_datetime
+from django.conf import settings
+from kombu.serialization import register as register_serializer
+
+from geoanalytics.blobs import BlobStore
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from shapely import wkb
+    from shapely.geometry.base import BaseGeometry
+except ImportError:
+    BaseGeometry = None
+
+NAME = "geoanalytics"
+CONTENT_TYPE = "application/x-geoanalytics-msgpack"
+
+NDARRAY = 1
+GEOMETRY = 2
+DATETIME = 3
+BLOB = 4
+
+payloads = BlobStore("task_payloads")
+
+_local = threading.local()
+
+
+def _default(obj):
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        if obj.dtype.hasobject:
+            # Its buffer holds pointers, not values.
+            raise TypeError("Can't serialize an array of objects: %r" % (obj,))
+        obj = numpy.ascontiguousarray(obj)
+        header = msgpack.packb([obj.dtype.str, obj.shape], use_bin_type=True)
+        return msgpack.ExtType(
+            NDARRAY, struct.pack(b"<I", len(header)) + header + obj.tostring())
+    if numpy is not None and isinstance(obj, numpy.generic):
+        return obj.item()
+    if BaseGeometry is not None and isinstance(obj, BaseGeometry):
+        return msgpack.ExtType(GEOMETRY, obj.wkb)
+    if isinstance(obj, (datetime, date)):
+        return msgpack.ExtType(DATETIME, obj.isoformat().encode("ascii"))
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError("Can't serialize %r" % (obj,))
+
+
+def _ext_hook(code, data):
+    if code == NDARRAY:
+        header_size, = struct.unpack(b"<I", data[:4])
+        dtype, shape = msgpack.unpackb(data[4:4 + header_size], encoding="utf-8")
+        dtype = numpy.dtype(dtype)
+        if dtype.hasobject:
+            raise ValueError("Can't deserialize an array of objects")
+        # A bytearray, so the array owns writable memory rather than a
+        # read-only view of the message.
+        buf = bytearray(data[4 + header_size:])
+        return numpy.frombuffer(buf, dtype=dtype).reshape(shape)
+    if code == GEOMETRY:
+        return wkb.loads(data)
+    if code == DATETIME:
+        return parse_datetime(data.decode("ascii"))
+    if code == BLOB:
+        return unpack(payloads.get(data.decode("ascii")))
+    return msgpack.ExtType(code, data)
+
+
+def pack(obj):
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def unpack(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, encoding="utf-8")
+
+
+def unpacker(f):
+    """
+    ``msgpack.Unpacker`` reading this encoding incrementally from ``f``.
+    """
+    return msgpack.Unpacker(f, ext_hook=_ext_hook, encoding="utf-8")
+
+
+def last_size():
+    """
+    Size in bytes of the last message ``dumps`` encoded on this thread,
+    before any offloading.
+    """
+    return getattr(_local, "size", 0)
+
+
+def dumps(obj):
+    data = pack(obj)
+    _local.size = len(data)
+    if len(data) > settings.CELERY_PAYLOAD_OFFLOAD_BYTES:
+        name = payloads.put(data)
+        data = msgpack.packb(msgpack.ExtType(BLOB, name.encode("ascii")))
+    return data
+
+
+def loads(data):
+    return unpack(data)
+
+
+def register():
+    register_serializer(NAME, dumps, loads, content_type=CONTENT_TYPE,
+                        content_encoding="binary")
@@ -0,0 +1,169 @@
+"""
+Compact session storage. Use ``MsgPackSerializer`` as
+``SESSION_SERIALIZER`` and this module as ``SESSION_ENGINE`` to keep
+sessions in the cache as raw msgpack bytes.
+
+Sessions hold little beyond a user id, a backend path and the odd
+message, so they pack to a few dozen bytes and decode without
+unpickling. Anything msgpack doesn't know how to pack natively
+(datetimes, ``Message`` objects) is stored as a pickled extension value
+so no existing session content is lost.
+"""
+from __future__ import absolute_import
+
+import msgpack
+import redis
+from django.conf import settings
+from django.contrib.sessions.backends.base import SessionBase, CreateError
+from django.contrib.sessions.backends.cache import KEY_PREFIX
+from django.core.cache import get_cache
+from django.utils.six.moves import cPickle as pickle, xrange
+
+PICKLED = 1
+
+
+def _default(obj):
+    return msgpack.ExtType(PICKLED, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+def _ext_hook(code, data):
+    if code == PICKLED:
+        return pickle.loads(data)
+    return msgpack.ExtType(code, data)
+
+
+def packb(obj):
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def unpackb(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, encoding='utf-8')
+
+
+def touch(cache, key, value, timeout):
+    """
+    Reset the expiry of ``key`` to ``timeout`` seconds. Django's cache API
+    can't do that on its own, so this goes to the client of the backends
+    that can (django-redis-cache, python-memcached with ``touch``) and
+    writes ``value`` again on any other.
+    """
+    client = getattr(cache, "_client", None)
+    if isinstance(client, redis.StrictRedis):
+        client.expire(cache.make_key(key), timeout)
+        return
+    client = getattr(cache, "_cache", None)
+    if hasattr(client, "touch"):
+        client.touch(cache.make_key(key), cache._get_memcache_timeout(timeout))
+        return
+    cache.set(key, value, timeout)
+
+
+class MsgPackSerializer(object):
+    """
+    msgpack counterpart of Django's ``PickleSerializer``, to be used in
+    ``signing.dumps`` and ``signing.loads``. Sessions encoded by the
+    pickle serializer are still read, so switching doesn't log anybody
+    out.
+    """
+    def dumps(self, obj):
+        return packb(obj)
+
+    def loads(self, data):
+        try:
+            return unpackb(data)
+        except Exception:
+            return pickle.loads(data)
+
+
+class SessionStore(SessionBase):
+    """
+    A cache-based session store which keeps sessions as msgpack bytes.
+
+    Like every Django session store, nothing is fetched until the view
+    first touches the session. On top of that:
+
+    * a cache miss doesn't write an empty session back straight away;
+      a key is only created if something actually gets stored.
+    * ``save`` skips the cache write if the encoded session is byte for
+      byte what was loaded, so assigning a value the session already
+      held costs nothing beyond pushing back its expiry.
+    """
+    def __init__(self, session_key=None):
+        self._cache = get_cache(settings.SESSION_CACHE_ALIAS)
+        self._loaded_data = None
+        super(SessionStore, self).__init__(session_key)
+
+    @property
+    def cache_key(self):
+        return KEY_PREFIX + self._get_or_create_session_key()
+
+    def load(self):
+        session_data = None
+        if self.session_key is not None:
+            try:
+                session_data = self._cache.get(self.cache_key, None)
+            except Exception:
+                # Some backends (e.g. memcache) raise an exception on
+                # invalid cache keys. If this happens, reset the session.
+                session_data = None
+        if session_data is None:
+            self._session_key = None
+            return {}
+        if isinstance(session_data, dict):
+            # Written by django.contrib.sessions.backends.cache before
+            # the switch; it gets re-encoded on the next save.
+            return session_data
+        try:
+            session = unpackb(session_data)
+        except Exception:
+            self._session_key = None
+            return {}
+        self._loaded_data = session_data
+        return session
+
+    def create(self):
+        # Same as Django's cache backend: a cache can fail silently, so
+        # we can't tell a key collision from a missing cache.
+        for i in xrange(10000):
+            self._session_key = self._get_new_session_key()
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue
+            self.modified = True
+            return
+        raise RuntimeError(
+            "Unable to create a new session key. "
+            "It is likely that the cache is unavailable.")
+
+    def save(self, must_create=False):
+        if self.session_key is None and not must_create:
+            return self.create()
+        session_data = packb(self._get_session(no_load=must_create))
+        if must_create:
+            result = self._cache.add(self.cache_key, session_data,
+                                     self.get_expiry_age())
+            if not result:
+                raise CreateError
+        elif session_data != self._loaded_data:
+            self._cache.set(self.cache_key, session_data, self.get_expiry_age())
+        else:
+            # SESSION_SAVE_EVERY_REQUEST and the like still expect the
+            # session to live on from now.
+            touch(self._cache, self.cache_key, session_data, self.get_expiry_age())
+        self._loaded_data = session_data
+
+    def exists(self, session_key):
+        return (KEY_PREFIX + session_key) in self._cache
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        self._cache.delete(KEY_PREFIX + session_key)
+        self._loaded_data = None
+
+    @classmethod
+    def clear_expired(cls):
+        pass
@@ -1,7 +1,9 @@
 from __future__ import absolute_import, unicode_literals
 import redis
 import os
+from datetime import timedelta
 from urlparse import urlparse
+from kombu import Queue
 
 REDIS_HOST = os.environ.get('REDIS_HOST_NAME', 'redis')
 REDIS_PORT = int(os.environ.get('REDIS_PORT_NAME', '6379'))
@@ -22,20 +24,84 @@ WMS_CACHE_DB = redis.Redis(
 
 
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
-SESSION_SERIALIZER="django.contrib.sessions.serializers.PickleSerializer"
+SESSION_SERIALIZER="geoanalytics.sessions.MsgPackSerializer"
 PERMISSIONS_DB=redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=5)
 QUOTA_DB = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=7)
 
+# page permission memo, see geoanalytics.permissions
+PAGE_PERMISSIONS_MIDDLEWARE = "ga_resources.middleware.PagePermissionsViewableMiddleware"
+PERMISSIONS_MEMO_SECONDS = 30
+PERMISSIONS_VERSION_CHECK_SECONDS = 2
+
 IPYTHON_SETTINGS=[]
 IPYTHON_BASE='/home/geoanalytics/ga_cms/static/media/ipython-notebook'
 IPYTHON_HOST='127.0.0.1'
 
 # celery settings
 BROKER_URL="redis://{REDIS_HOST}:6379/0".format(REDIS_HOST=REDIS_HOST)
-CELERY_ACCEPT_CONTENT = ['pickle', 'json', 'msgpack', 'yaml']
-CELERY_RESULT_BACKEND = BROKER_URL
+# geoanalytics.serialization: msgpack with numpy, Shapely and datetime
+# support, offloading large payloads to BLOB_ROOT. Pickle is no longer
+# accepted, so task arguments must be plain data, arrays or geometries.
+CELERY_ACCEPT_CONTENT = ['geoanalytics', 'json', 'msgpack']
+CELERY_TASK_SERIALIZER = 'geoanalytics'
+CELERY_RESULT_SERIALIZER = 'geoanalytics'
+CELERY_PAYLOAD_OFFLOAD_BYTES = 256 * 1024
+CELERY_PAYLOAD_TTL = 60 * 60 * 24 * 7
+# Results live in their own Redis db and expire; big ones go to disk
+# (see geoanalytics.results).
+CELERY_RESULT_BACKEND = "geoanalytics.results:ResultStore+redis://{REDIS_HOST}:6379/1".format(REDIS_HOST=REDIS_HOST)
+CELERY_TASK_RESULT_EXPIRES = 60 * 60 * 6
+CELERY_RESULT_COMPRESS_BYTES = 4 * 1024
+CELERY_RESULT_DISK_BYTES = 256 * 1024
 CELERYD_TASK_SOFT_TIME_LIMIT = 15
 
+# Latency-sensitive and bulk work get queues of their own, so a long
+# ingest never holds up tile rendering. Tasks pick a queue with
+# @app.task(queue=...), or by name prefix through QueueRouter.
+CELERY_QUEUES = (
+    Queue('render', routing_key='render'),
+    Queue('ingest', routing_key='ingest'),
+    Queue('analytics', routing_key='analytics'),
+    Queue('housekeeping', routing_key='housekeeping'),
+    Queue('seed', routing_key='seed'),
+)
+CELERY_DEFAULT_QUEUE = 'analytics'
+CELERY_DEFAULT_ROUTING_KEY = 'analytics'
+CELERY_ROUTES = ('geoanalytics.celery.QueueRouter',)
+CELERY_TASK_QUEUE_PREFIXES = (
+    ('celery.', 'housekeeping'),
+)
+
+# One worker pool per queue, started by ``manage.py celery_pools``.
+# Render tasks are short and should never be prefetched behind each
+# other; ingest tasks are long, so each process takes one at a time.
+CELERY_WORKER_POOLS = {
+    'render': {'concurrency': 4, 'prefetch_multiplier': 1},
+    'ingest': {'concurrency': 2, 'prefetch_multiplier': 1, 'max_tasks_per_child': 10},
+    'analytics': {'concurrency': 2, 'prefetch_multiplier': 1},
+    'housekeeping': {'concurrency': 1, 'prefetch_multiplier': 4, 'beat': True},
+    'seed': {'concurrency': 1, 'prefetch_multiplier': 1},
+}
+CELERYBEAT_SCHEDULE = {
+    'purge-task-payloads': {
+        'task': 'geoanalytics.tasks.purge_task_payloads',
+        'schedule': timedelta(hours=1),
+    },
+    'purge-task-results': {
+        'task': 'geoanalytics.tasks.purge_task_results',
+        'schedule': timedelta(hours=1),
+    },
+    'purge-uploads': {
+        'task': 'geoanalytics.tasks.purge_uploads',
+        'schedule': timedelta(hours=1),
+    },
+}
+# Set per pool by celery_pools.
+CELERYD_PREFETCH_MULTIPLIER = int(os.environ.get('CELERYD_PREFETCH_MULTIPLIER', 4))
+
+# how long progress and chunk results of geoanalytics.chunked jobs are kept
+CHUNKED_JOB_TTL = 60 * 60 * 24
+
 # cache settings
 # CACHES = {
 #     "default": {
@@ -48,9 +114,45 @@ CELERYD_TASK_SOFT_TIME_LIMIT = 15
 #     }
 # }
 
+# page cache stampede protection, see geoanalytics.middleware
+CACHE_EARLY_EXPIRY_BETA = 1.0   # >1 favours earlier refreshes
+CACHE_STALE_SECONDS = 30        # how long a stale page may still be served
+CACHE_LOCK_SECONDS = 10         # max time one request holds a render lock
+CACHE_LOCK_WAIT_SECONDS = 2     # max time a request waits on another's render
+
+# request coalescing, see geoanalytics.singleflight
+SINGLEFLIGHT_LOCK_SECONDS = 30    # max time one caller computes for the others
+SINGLEFLIGHT_WAIT_SECONDS = 10    # max time a caller waits on another's result
+SINGLEFLIGHT_RESULT_SECONDS = 10  # how long a result is kept for the waiters
+
 # carto settings
 CARTO_HOME='/home/docker/node_modules/carto'
 
+# tile cache and seeding, see geoanalytics.tiles and geoanalytics.seeding
+TILE_CACHE_SECONDS = 60 * 60 * 24 * 7
+TILE_PUBLIC_CACHE_SECONDS = 300   # max-age of tiles of public layers
+TILE_VERSION_CHECK_SECONDS = 2    # how quickly a publish reaches all workers
+TILE_METATILE_SIZE = 4            # tiles per side rendered in one pass
+TILE_METATILE_BUFFER = 64         # pixels drawn past the metatile edges
+MAP_POOL_SIZE = 32                # idle mapnik maps kept per process
+MAP_POOL_MAX_RSS = 1024 * 1024 * 1024  # recycle a worker once it is this big
+MAP_POOL_WARM_COUNT = 8           # maps preloaded when a worker starts
+TILE_SEED_ZOOMS = range(0, 10)    # the whole world at these is 21,847 metatiles
+TILE_SEED_MAX_METATILES = 50000   # refuse seeding jobs larger than this
+TILE_SEED_PAUSE_RATIO = 1.0       # pause after a render, relative to its time
+TILE_SEED_MAX_LOAD = 0.8          # load average per CPU above which seeding waits
+TILE_SEED_MAX_WAIT_SECONDS = 60
+TILE_SEED_ON_PUBLISH_ZOOMS = range(0, 7)  # reseeded when a layer changes
+PUBLISH_TASK_DELAY = 10          # seconds before compiling/seeding a saved layer
+STYLE_COMPILE_LOCK_SECONDS = 60  # one queued compile per stylesheet within this
+STYLE_ERROR_SECONDS = 300        # a failed compile is reported, not retried, within this
+
+# requests sent to a new release before it goes live, see the
+# warm_release command and fabfile.deploy
+WARMUP_URLS = ("/",)
+WARMUP_TILE_LAYERS = 8            # most used layers and styles to request tiles of
+WARMUP_TILE_ZOOMS = range(0, 3)
+
 ######################
 # MEZZANINE SETTINGS #
 ######################
@@ -210,6 +312,15 @@ FILE_UPLOAD_PERMISSIONS = 0o644
 FILE_UPLOAD_HANDLERS = (
  "django.core.files.uploadhandler.TemporaryFileUploadHandler",)
 
+# Resumable dataset uploads, see geoanalytics.uploads. These bypass
+# FILE_UPLOAD_HANDLERS and stream each chunk into BLOB_ROOT; nginx caps
+# the size of a chunk (deploy/nginx.conf), not of the upload.
+UPLOAD_MAX_BYTES = 8 * 1024 ** 3
+UPLOAD_BUFFER_BYTES = 256 * 1024    # read from the request at a time
+UPLOAD_EXPIRE_SECONDS = 60 * 60 * 24  # abandoned after this long without a chunk
+UPLOAD_LOCK_SECONDS = 60 * 5        # max time one chunk may take to arrive
+ARCHIVE_INSPECTION_SECONDS = 60 * 60 * 24 * 7  # see geoanalytics.archives.inspect
+
 
 #############
 # DATABASES #
@@ -269,6 +380,43 @@ MEDIA_URL = STATIC_URL + "media/"
 # Example: "/home/media/media.lawrence.com/media/"
 MEDIA_ROOT = os.path.join(PROJECT_ROOT, *MEDIA_URL.strip("/").split("/"))
 
+# Absolute path to the directory geoanalytics.blobs keeps task payloads
+# and results, compiled styles and partial uploads in. It must be shared
+# by every web and worker process, and kept out of STATIC_ROOT and
+# MEDIA_ROOT so none of it is ever served or backed up with the media.
+BLOB_ROOT = os.path.join(PROJECT_ROOT, "blobs")
+
+# URL prefixes of the tile, feature and API endpoints.
+TILE_URL_PREFIXES = ("/ga_resources/wms/", "/ga_resources/tms/", "/tiles/")
+FEATURE_URL_PREFIXES = ("/ga_resources/wfs/",)
+API_URL_PREFIXES = ("/ga_resources/api/",)
+DOWNLOAD_URL_PREFIXES = ("/download/",)
+
+# Data resource downloads are authorized by Django and sent by nginx
+# from this internal location, see deploy/nginx.conf.
+USE_X_ACCEL_REDIRECT = False
+X_ACCEL_REDIRECT_PREFIX = "/protected-media/"
+
+# URL prefixes that never go through the page permission check. Tile
+# endpoints check access to their layers themselves.
+PAGE_PERMISSIONS_SKIP_PREFIXES = (STATIC_URL,) + TILE_URL_PREFIXES
+
+# Read-only requests under these prefixes are served by the slim handler
+# in geoanalytics.wsgi with FAST_PATH_MIDDLEWARE_CLASSES only.
+FAST_PATH_PREFIXES = (TILE_URL_PREFIXES + FEATURE_URL_PREFIXES +
+                      API_URL_PREFIXES + DOWNLOAD_URL_PREFIXES)
+
+# request statistics and sampled profiling, see geoanalytics.instrumentation
+REQUEST_STATS_ENABLED = True
+STATS_FLUSH_SECONDS = 10        # how often each worker pushes its numbers
+STATS_WINDOW_SECONDS = 60       # granularity of the rolling windows
+STATS_RETENTION_SECONDS = 3600  # how long windows are kept in Redis
+PROFILE_SAMPLE_RATE = 0.01      # fraction of requests run under cProfile
+PROFILE_SLOW_SECONDS = 1.0      # sampled requests slower than this are saved
+PROFILE_DIR = os.path.join(PROJECT_ROOT, "profiles")
+TASK_STATS_ENABLED = True
+TASK_STATS_SENT_SECONDS = 60 * 60 * 24  # how long a queued task's send time is kept
+
 # Package/module name to import the root urlpatterns from for the project.
 ROOT_URLCONF = "%s.urls" % PROJECT_DIRNAME
 
@@ -312,6 +460,7 @@ INSTALLED_APPS = (
     # "mezzanine.twitter",
     "mezzanine.accounts",
     # "mezzanine.mobile",
+    "geoanalytics",
     "ga_resources",
     "ga_ows",
     "gunicorn",
@@ -337,7 +486,9 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 # these middleware classes will be applied in the order given, and in the
 # response phase the middleware will be applied in reverse order.
 MIDDLEWARE_CLASSES = (
+    "geoanalytics.middleware.RequestStatsMiddleware",
     "mezzanine.core.middleware.UpdateCacheMiddleware",
+    "geoanalytics.middleware.UpdatePageCacheMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.locale.LocaleMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
@@ -353,8 +504,17 @@ MIDDLEWARE_CLASSES = (
     # Uncomment the following if using any of the SSL settings:
     # "mezzanine.core.middleware.SSLRedirectMiddleware",
     "mezzanine.pages.middleware.PageMiddleware",
+    "geoanalytics.middleware.FetchPageCacheMiddleware",
     "mezzanine.core.middleware.FetchFromCacheMiddleware",
-    "ga_resources.middleware.PagePermissionsViewableMiddleware",
+    "geoanalytics.middleware.PagePermissionsViewableMiddleware",
+)
+
+# Middleware for the tile, feature and API fast path (FAST_PATH_PREFIXES).
+FAST_PATH_MIDDLEWARE_CLASSES = (
+    "geoanalytics.middleware.RequestStatsMiddleware",
+    "django.contrib.sessions.middleware.SessionMiddleware",
+    "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "geoanalytics.middleware.PagePermissionsViewableMiddleware",
 )
 
 # Store these package names here as they may change in the future since
@@ -392,7 +552,19 @@ DEBUG_TOOLBAR_CONFIG = {"INTERCEPT_REDIRECTS": False}
 #     "VIRTUALENV_HOME":  "", # Absolute remote path for virtualenvs
 #     "PROJECT_NAME": "", # Unique identifier for project
 #     "REQUIREMENTS_PATH": "", # Path to pip requirements, relative to project
+#     "WHEELHOUSE_URL": "", # Prebuilt wheels, in a directory per requirements hash
 #     "GUNICORN_PORT": 8000, # Port gunicorn will listen on
+#     "GUNICORN_TILES_PORT": 8001, # Port the tile gunicorn will listen on
+#     "RELEASE_PORT_OFFSET": 10, # Added to both ports for the green release
+#     "DRAIN_SECONDS": 30, # Time the old release gets to finish its requests
+#     "DEPLOY_POOL_SIZE": 4, # Hosts deployed to at once
+#     "DEPLOY_BATCH_SIZE": 4, # Hosts per rolling batch
+#     "DEPLOY_CANARY_HOSTS": 1, # Hosts in the first batch
+#     "HEALTH_CHECK_URLS": ["/"], # Must answer on each host after its deploy
+#     "BACKUP_PATH": "", # Remote path for database dumps and static snapshots
+#     "BACKUP_JOBS": 4, # Parallel pg_dump/pg_restore jobs
+#     "BACKUP_COMPRESSION": 1, # pg_dump compression level, 0-9
+#     "BACKUP_SKIP_TABLES": "deploy/backup_skip_tables", # Tables not to back up
 #     "LOCALE": "en_US.UTF-8", # Should end with ".UTF-8"
 #     "LIVE_HOSTNAME": "www.example.com", # Host for public site.
 #     "REPO_URL": "", # Git or Mercurial remote repo URL for the project
@@ -0,0 +1,148 @@
+"""
+Request coalescing ("single flight") across threads and processes.
+
+``single_flight.do(key, compute)`` runs ``compute`` once for all callers
+asking for the same key at the same time, wherever they are:
+
+* threads of one process wait on the first caller and share its return
+  value;
+* one caller per key holds a Redis lock for up to
+  ``SINGLEFLIGHT_LOCK_SECONDS`` while it computes. Callers in other
+  processes block on a wait channel, a Redis list the lock holder pushes
+  to when done, for at most ``SINGLEFLIGHT_WAIT_SECONDS``, and then
+  read the result instead of computing it.
+
+Where the result ends up somewhere shared anyway, like the tile cache,
+pass ``fetch`` to read it back from there. Otherwise the result is
+handed over packed in Redis for ``SINGLEFLIGHT_RESULT_SECONDS``. If the
+lock holder fails or is too slow the waiting callers compute the result
+themselves.
+
+``request_key`` builds a key from request parameters, normalized so
+that equivalent requests share one flight.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import math
+import threading
+from hashlib import sha1
+
+from django.conf import settings
+
+from geoanalytics import locks, serialization
+
+
+def _normalize(value):
+    if isinstance(value, float):
+        return "%.10g" % value
+    if isinstance(value, (list, tuple)):
+        return ",".join(_normalize(v) for v in value)
+    if isinstance(value, basestring):
+        return value.strip().lower()
+    return "%s" % (value,)
+
+
+def request_key(namespace, **params):
+    """
+    A key for a request like ``request_key("wms", layer=..., style=...,
+    bbox=..., size=..., srs=..., time=...)``. Floats are compared to 10
+    significant digits and strings case insensitively.
+    """
+    normalized = "&".join("%s=%s" % (name, _normalize(params[name]))
+                          for name in sorted(params))
+    return "%s:%s" % (namespace, sha1(normalized.encode("utf-8")).hexdigest())
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    @property
+    def db(self):
+        return settings.REDIS_CONNECTION
+
+    def do(self, key, compute, fetch=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.done.wait(settings.SINGLEFLIGHT_WAIT_SECONDS) and call.error is None:
+                return call.result
+            return compute()
+
+        try:
+            call.result = self._do_shared(key, compute, fetch)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _do_shared(self, key, compute, fetch):
+        lock = "ga.singleflight:" + key
+        token = locks.new_token()
+        if self.db.set(lock, token, ex=settings.SINGLEFLIGHT_LOCK_SECONDS, nx=True):
+            return self._lead(lock, token, compute, fetch)
+
+        token = self.db.get(lock)
+        if token is not None:
+            # BRPOPLPUSH onto the same list leaves the signal in place for
+            # every other waiter.
+            done = "%s:%s:done" % (lock, token.decode("ascii"))
+            timeout = int(math.ceil(settings.SINGLEFLIGHT_WAIT_SECONDS))
+            self.db.brpoplpush(done, done, timeout)
+        else:
+            # The holder finished between our SET and GET, so its result
+            # is already there to read.
+            token = self.db.get(lock + ":last")
+        result = self._result(lock, token, fetch)
+        if result is not None:
+            return result
+        return compute()
+
+    def _result(self, lock, token, fetch):
+        if fetch is not None:
+            return fetch()
+        if token is None:
+            return None
+        result = self.db.get("%s:%s:result" % (lock, token.decode("ascii")))
+        if result is not None:
+            result = serialization.unpack(result)
+        return result
+
+    def _lead(self, lock, token, compute, fetch):
+        ttl = settings.SINGLEFLIGHT_RESULT_SECONDS
+        pipe = self.db.pipeline()
+        try:
+            result = compute()
+            if fetch is None:
+                # self.db is a redis.Redis, so setex takes the value first.
+                pipe.setex("%s:%s:result" % (lock, token),
+                           serialization.pack(result), ttl)
+                pipe.setex(lock + ":last", token, ttl)
+            return result
+        finally:
+            done = "%s:%s:done" % (lock, token)
+            # The lock may have expired during a slow compute and been
+            # taken by another caller.
+            locks.release(self.db, lock, token, client=pipe)
+            pipe.rpush(done, 1)
+            pipe.expire(done, ttl)
+            pipe.execute()
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,173 @@
+"""
+CartoCSS to Mapnik XML for rendered layers.
+
+A layer's stylesheet is compiled together with its data resource into a
+carto project, which the node ``carto`` compiler under ``CARTO_HOME``
+turns into Mapnik XML. Compiled XML is kept on disk under the private
+``BLOB_ROOT``, since it holds the datasources' database credentials,
+named by a hash of the whole project, and in memory in each process, so
+a stylesheet is only ever compiled once.
+
+Compiling is left to the ``compile_style`` task, queued when a layer,
+style or data resource is saved. ``mapnik_xml``, which serves requests,
+never runs node: if the XML isn't there yet it queues a compile and
+raises ``StyleNotReady``. A stylesheet carto can't compile is
+remembered for ``STYLE_ERROR_SECONDS``, and ``mapnik_xml`` raises its
+``StyleError`` instead of queueing it again.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import json
+import os
+import re
+import subprocess
+import tempfile
+from hashlib import sha1
+
+from django.conf import settings
+
+from geoanalytics.blobs import BlobStore
+from geoanalytics.tiles import MERCATOR_SRS, tile_cache
+
+MAX_MEMO_ENTRIES = 256
+
+compiled = BlobStore("compiled_styles")
+
+# (layer, style, tile cache version) -> XML
+_memo = {}
+
+
+class StyleError(Exception):
+    pass
+
+
+class StyleNotReady(StyleError):
+    pass
+
+
+def get_layer(slug):
+    from ga_resources.models import RenderedLayer
+    return RenderedLayer.objects.select_related(
+        "default_style", "data_resource").get(slug=slug)
+
+
+def get_style(layer, style=""):
+    """
+    The ``Style`` called ``style`` among the layer's styles, or its
+    default style.
+    """
+    if not style:
+        return layer.default_style
+    return layer.styles.get(slug=style)
+
+
+def layer_id(layer):
+    # Stylesheets select the layer as #<last part of its slug>.
+    return re.sub(r"\W", "_", layer.slug.rsplit("/", 1)[-1])
+
+
+def carto_project(layer, style):
+    """
+    The carto project (MML) for drawing ``layer`` with ``style``.
+    """
+    _, srs, datasource = layer.data_resource.driver_instance.ready_data_resource()
+    if not isinstance(srs, basestring):
+        srs = srs.ExportToProj4()
+    return {
+        "srs": MERCATOR_SRS,
+        "Stylesheet": [{"id": "style.mss", "data": style.stylesheet}],
+        "Layer": [{
+            "id": layer_id(layer),
+            "name": layer_id(layer),
+            "class": "default",
+            "srs": srs,
+            "Datasource": datasource,
+        }],
+    }
+
+
+def project_hash(project):
+    return sha1(json.dumps(project, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def compile_project(project):
+    """
+    Run ``carto`` on a project and return the Mapnik XML.
+    """
+    fd, path = tempfile.mkstemp(suffix=".mml")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(project, f)
+        carto = subprocess.Popen(
+            [os.path.join(settings.CARTO_HOME, "bin", "carto"), path],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        xml, errors = carto.communicate()
+    finally:
+        os.remove(path)
+    if carto.returncode:
+        raise StyleError(errors.decode("utf-8", "replace"))
+    return xml
+
+
+def _read_compiled(name):
+    try:
+        return compiled.get(name)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def compile_style(layer, style=""):
+    """
+    Compile the XML for a layer and style, both slugs, unless it is
+    already on disk. Runs node, so only call it from a worker.
+    """
+    layer = get_layer(layer)
+    project = carto_project(layer, get_style(layer, style))
+    name = project_hash(project)
+    xml = _read_compiled(name)
+    if xml is None:
+        try:
+            xml = compile_project(project)
+        except StyleError as e:
+            # WMS_CACHE_DB is a redis.Redis, so setex takes the value first.
+            tile_cache.db.setex("ga.styles.error:" + name, ("%s" % e).encode("utf-8"),
+                                settings.STYLE_ERROR_SECONDS)
+            raise
+        compiled.put(xml, name)
+    return xml
+
+
+def _queue_compile(name, layer, style):
+    from geoanalytics.tasks import compile_style as compile_style_task
+
+    # One queued compile per project, however many requests ask for it.
+    if tile_cache.db.set("ga.styles.compiling:" + name, 1,
+                         ex=settings.STYLE_COMPILE_LOCK_SECONDS, nx=True):
+        compile_style_task.delay(layer, style)
+
+
+def mapnik_xml(layer, style=""):
+    """
+    The compiled XML for a layer and style, both slugs. Raises
+    ``StyleNotReady`` if it hasn't been compiled yet, and ``StyleError``
+    with carto's message if compiling it failed.
+    """
+    key = (layer, style, tile_cache.version(layer))
+    xml = _memo.get(key)
+    if xml is None:
+        layer_obj = get_layer(layer)
+        name = project_hash(carto_project(layer_obj, get_style(layer_obj, style)))
+        xml = _read_compiled(name)
+        if xml is None:
+            error = tile_cache.db.get("ga.styles.error:" + name)
+            if error is not None:
+                raise StyleError(error.decode("utf-8"))
+            _queue_compile(name, layer, style)
+            raise StyleNotReady("%s is being compiled" % layer)
+        if len(_memo) >= MAX_MEMO_ENTRIES:
+            _memo.clear()
+        _memo[key] = xml
+    return xml
@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+
+from geoanalytics import chunked, results, seeding, serialization, styles, uploads
+from geoanalytics.celery import app
+
+
+@app.task(bind=True, max_retries=5, ignore_result=False)
+def run_chunk(self, job_id, index):
+    """
+    Process one chunk of a ``geoanalytics.chunked`` job. A chunk that
+    runs out of time is retried and picks up from its last checkpoint.
+    """
+    try:
+        chunked.process_chunk(job_id, index)
+    except SoftTimeLimitExceeded as exc:
+        raise self.retry(exc=exc, countdown=0)
+
+
+@app.task
+def assemble_chunks(job_id):
+    """
+    Chord callback combining the results of a ``geoanalytics.chunked`` job.
+    """
+    return chunked.assemble_job(job_id)
+
+
+@app.task(queue='housekeeping')
+def purge_task_payloads():
+    """
+    Delete offloaded task payloads older than ``CELERY_PAYLOAD_TTL``.
+    """
+    return serialization.payloads.purge(settings.CELERY_PAYLOAD_TTL)
+
+
+@app.task(queue='housekeeping')
+def purge_task_results():
+    """
+    Delete result files older than ``CELERY_TASK_RESULT_EXPIRES``, by
+    which time their Redis entries are gone.
+    """
+    return results.purge(settings.CELERY_TASK_RESULT_EXPIRES)
+
+
+@app.task(queue='seed')
+def seed_layer(layer, style='', bbox=None, zooms=None):
+    """
+    Start a ``geoanalytics.seeding`` job for a layer and return its id.
+    """
+    return seeding.seed(layer, style, bbox, zooms)
+
+
+@app.task(queue='render')
+def compile_style(layer, style=''):
+    """
+    Compile a layer's CartoCSS to Mapnik XML ahead of the first request
+    that needs it.
+    """
+    styles.compile_style(layer, style)
+
+
+@app.task(queue='ingest')
+def ingest_upload(upload_id):
+    """
+    Turn a completed ``geoanalytics.uploads`` upload into a data resource.
+    """
+    return uploads.ingest(upload_id)
+
+
+@app.task(queue='housekeeping')
+def purge_uploads():
+    """
+    Delete partial uploads abandoned for ``UPLOAD_EXPIRE_SECONDS``.
+    """
+    return uploads.purge(settings.UPLOAD_EXPIRE_SECONDS)
@@ -0,0 +1,262 @@
+from __future__ import absolute_import, unicode_literals
+
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+
+from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase
+from django.test.utils import override_settings
+
+from geoanalytics import archives, uploads
+
+
+class MemoryPipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        return lambda *args, **kwargs: self.calls.append((method, args, kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+class MemoryRedis(object):
+    """
+    The few ``redis.Redis`` commands these tests need, expiry aside.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def setex(self, key, value, time):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def expire(self, key, time):
+        pass
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hmset(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def pipeline(self):
+        return MemoryPipeline(self)
+
+    def register_script(self, script):
+        # Only locks.RELEASE_LOCK is run here.
+        def release(keys, args, client=None):
+            if self.data.get(keys[0]) == args[0]:
+                self.delete(keys[0])
+                return 1
+            return 0
+        return release
+
+
+class RecordingTask(object):
+    def __init__(self):
+        self.calls = []
+
+    def delay(self, *args):
+        self.calls.append(args)
+
+
+def _zip(members):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in members:
+            archive.writestr(name, content)
+    return data.getvalue()
+
+
+class ZipScannerTest(SimpleTestCase):
+    def test_finds_members_as_chunks_arrive(self):
+        data = _zip([("roads.shp", b"x" * 5000), ("roads.dbf", b"y" * 100)])
+        scanner = archives.ZipScanner()
+        for available in range(0, len(data), 37):
+            scanner.scan(io.BytesIO(data[:available]), available)
+        scanner.scan(io.BytesIO(data), len(data))
+        self.assertEqual(scanner.state["members"], ["roads.shp", "roads.dbf"])
+        self.assertTrue(scanner.state["done"])
+
+    def test_reads_sizes_of_zip64_members(self):
+        data = b""
+        for name, content in (("roads.shp", b"x" * 5000), ("roads.dbf", b"y" * 100)):
+            info = zipfile.ZipInfo(name)
+            info.file_size = info.compress_size = len(content)
+            info.CRC = zlib.crc32(content) & 0xffffffff
+            data += info.FileHeader(zip64=True) + content
+        data += b"PK\x05\x06" + b"\0" * 18
+        scanner = archives.ZipScanner()
+        scanner.scan(io.BytesIO(data), len(data))
+        self.assertEqual(scanner.state["members"], ["roads.shp", "roads.dbf"])
+        self.assertTrue(scanner.state["done"])
+
+    def test_refuses_data_that_isnt_a_zip(self):
+        with self.assertRaises(archives.ArchiveError):
+            archives.ZipScanner().scan(io.BytesIO(b"GIF89a" + b"\0" * 64), 70)
+
+    def test_refuses_unsafe_member_names(self):
+        data = _zip([("../../etc/passwd", b"root")])
+        with self.assertRaises(archives.ArchiveError):
+            archives.ZipScanner().scan(io.BytesIO(data), len(data))
+
+
+class ShapefileLayersTest(SimpleTestCase):
+    def test_groups_parts_by_shapefile(self):
+        layers = archives.shapefile_layers(
+            ["a/roads.shp", "a/roads.SHX", "a/roads.dbf", "a/roads.prj", "readme.txt"])
+        self.assertEqual(layers, {"a/roads": {
+            ".shp": "a/roads.shp", ".shx": "a/roads.SHX",
+            ".dbf": "a/roads.dbf", ".prj": "a/roads.prj"}})
+
+    def test_refuses_incomplete_shapefile(self):
+        with self.assertRaises(archives.ArchiveError):
+            archives.shapefile_layers(["roads.shp", "roads.dbf"])
+
+
+class InspectTest(SimpleTestCase):
+    def setUp(self):
+        import fiona
+
+        self.directory = tempfile.mkdtemp()
+        schema = {"geometry": "Point", "properties": {"name": "str"}}
+        shp = os.path.join(self.directory, "towns.shp")
+        with fiona.open(shp, "w", driver="ESRI Shapefile", schema=schema,
+                        crs={"init": "epsg:4326", "no_defs": True}) as towns:
+            towns.write({"geometry": {"type": "Point", "coordinates": (-79.0, 35.9)},
+                         "properties": {"name": "Chapel Hill"}})
+            towns.write({"geometry": {"type": "Point", "coordinates": (-78.6, 35.8)},
+                         "properties": {"name": "Raleigh"}})
+        self.path = os.path.join(self.directory, "towns.zip")
+        with zipfile.ZipFile(self.path, "w") as archive:
+            for extension in (".shp", ".shx", ".dbf", ".prj"):
+                archive.write(os.path.join(self.directory, "towns" + extension),
+                              "data/towns" + extension)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_inspects_zipped_shapefile(self):
+        redis = MemoryRedis()
+        with override_settings(REDIS_CONNECTION=redis):
+            layers = archives.inspect(self.path)
+            self.assertEqual(archives.inspect(self.path), layers)
+        towns = layers["data/towns"]
+        self.assertEqual(towns["count"], 2)
+        self.assertEqual(towns["schema"]["geometry"], "Point")
+        self.assertIn("name", towns["schema"]["properties"])
+        self.assertEqual([round(v, 1) for v in towns["bounds"]], [-79.0, 35.8, -78.6, 35.9])
+        self.assertIn("WGS", towns["crs_wkt"])
+        self.assertEqual(len(redis.data), 1)
+
+
+class AppendTest(SimpleTestCase):
+    def setUp(self):
+        from geoanalytics import tasks
+
+        self.media_root = tempfile.mkdtemp()
+        self.ingest_upload = tasks.ingest_upload
+        tasks.ingest_upload = RecordingTask()
+        self.redis = MemoryRedis()
+        self.settings = override_settings(REDIS_CONNECTION=self.redis,
+                                          MEDIA_ROOT=os.path.join(self.media_root, "media"),
+                                          BLOB_ROOT=os.path.join(self.media_root, "blobs"))
+        self.settings.enable()
+
+    def tearDown(self):
+        from geoanalytics import tasks
+
+        self.settings.disable()
+        tasks.ingest_upload = self.ingest_upload
+        shutil.rmtree(self.media_root)
+
+    def test_completes_with_the_last_chunk(self):
+        from geoanalytics import tasks
+
+        upload_id = uploads.create(1, "towns.csv", 8)
+        self.assertEqual(uploads.append(upload_id, 0, io.BytesIO(b"name\n"), 5), 5)
+        self.assertEqual(uploads.append(upload_id, 5, io.BytesIO(b"a\nb"), 3), 8)
+        state = uploads.get(upload_id)
+        self.assertEqual(state["status"], "complete")
+        with open(os.path.join(self.media_root, "media", state["path"]), "rb") as f:
+            self.assertEqual(f.read(), b"name\na\nb")
+        self.assertEqual(tasks.ingest_upload.calls, [(upload_id,)])
+        self.assertNotIn("ga.uploads.lock:" + upload_id, self.redis.data)
+
+    def test_completes_only_once(self):
+        from geoanalytics import tasks
+
+        upload_id = uploads.create(1, "towns.csv", 4)
+        uploads.append(upload_id, 0, io.BytesIO(b"name"), 4)
+        # A client retrying the last chunk with nothing left to send.
+        with self.assertRaises(uploads.OffsetMismatch):
+            uploads.append(upload_id, 4, io.BytesIO(b""), 0)
+        self.assertEqual(tasks.ingest_upload.calls, [(upload_id,)])
+
+    def test_keeps_a_lock_taken_over_by_another_request(self):
+        upload_id = uploads.create(1, "towns.csv", 8)
+        lock = "ga.uploads.lock:" + upload_id
+        redis = self.redis
+
+        class SlowStream(io.BytesIO):
+            def read(self, size=-1):
+                # The lock expires mid-chunk and another request takes it.
+                redis.data[lock] = "theirs"
+                return io.BytesIO.read(self, size)
+
+        uploads.append(upload_id, 0, SlowStream(b"name\n"), 5)
+        self.assertEqual(self.redis.data[lock], "theirs")
+
+
+class UploadCsrfTest(SimpleTestCase):
+    """
+    tus clients send the CSRF token in an X-CSRFToken header.
+    """
+    def patch(self, **headers):
+        from django.middleware.csrf import CsrfViewMiddleware
+        from geoanalytics.views import upload
+
+        request = RequestFactory().patch(
+            "/uploads/" + "0" * 32, b"name", content_type="application/offset+octet-stream",
+            HTTP_TUS_RESUMABLE="1.0.0", HTTP_UPLOAD_OFFSET="0", **headers)
+        request.COOKIES[settings.CSRF_COOKIE_NAME] = "a" * 32
+        return CsrfViewMiddleware().process_view(request, upload, (), {})
+
+    def test_accepts_token_header(self):
+        self.assertIsNone(self.patch(HTTP_X_CSRFTOKEN="a" * 32))
+
+    def test_refuses_chunk_without_token(self):
+        self.assertEqual(self.patch().status_code, 403)
@@ -0,0 +1,149 @@
+"""
+Spherical mercator tile grid and the shared tile cache.
+
+Tiles are addressed ``(z, x, y)`` with the origin at the top left, as
+OpenLayers and Leaflet request them. Cached tiles live in
+``WMS_CACHE_DB`` under a per-layer version, so publishing a layer makes
+all of its old tiles unreachable at once; they are left to expire after
+``TILE_CACHE_SECONDS``.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import math
+from time import time
+
+from django.conf import settings
+
+TILE_SIZE = 256
+MERCATOR_SRS = "+init=epsg:3857"
+MERCATOR_EXTENT = 20037508.342789244
+MAX_LATITUDE = 85.0511287798
+
+
+def tile_bbox(z, x, y, span=1):
+    """
+    Mercator bounds ``(minx, miny, maxx, maxy)`` of the ``span`` x
+    ``span`` block of tiles whose top left tile is ``(z, x, y)``.
+    """
+    size = 2 * MERCATOR_EXTENT / 2 ** z
+    minx = -MERCATOR_EXTENT + x * size
+    maxy = MERCATOR_EXTENT - y * size
+    return minx, maxy - span * size, minx + span * size, maxy
+
+
+def tile_for_lonlat(lon, lat, z):
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    n = 2 ** z
+    x = (lon + 180.0) / 360.0 * n
+    lat = math.radians(lat)
+    y = (1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n
+    return min(n - 1, max(0, int(x))), min(n - 1, max(0, int(y)))
+
+
+def tile_range(bbox, z):
+    """
+    ``(minx, miny, maxx, maxy)`` tile numbers at zoom ``z`` covering a
+    lon/lat ``bbox``, inclusive.
+    """
+    west, south, east, north = bbox
+    minx, miny = tile_for_lonlat(west, north, z)
+    maxx, maxy = tile_for_lonlat(east, south, z)
+    return minx, miny, maxx, maxy
+
+
+def metatiles(bbox, zooms, size):
+    """
+    Yield ``(z, mx, my)`` for every ``size`` x ``size`` block of tiles
+    touching a lon/lat ``bbox`` at each zoom level in ``zooms``.
+    """
+    for z in zooms:
+        minx, miny, maxx, maxy = tile_range(bbox, z)
+        for my in range(miny // size, maxy // size + 1):
+            for mx in range(minx // size, maxx // size + 1):
+                yield z, mx, my
+
+
+def metatile_tiles(z, mx, my, size):
+    """
+    The ``(z, x, y)`` tiles making up a metatile, clipped to the grid.
+    """
+    n = 2 ** z
+    return [(z, x, y)
+            for y in range(my * size, min(n, (my + 1) * size))
+            for x in range(mx * size, min(n, (mx + 1) * size))]
+
+
+class TileCache(object):
+    """
+    Rendered tiles in ``WMS_CACHE_DB``, keyed by layer, style and tile.
+    ``style`` is a style slug, or ``""`` for the layer's default style.
+    """
+    def __init__(self):
+        self._versions = {}
+
+    @property
+    def db(self):
+        return settings.WMS_CACHE_DB
+
+    def version(self, layer):
+        # Checked against Redis at most every TILE_VERSION_CHECK_SECONDS,
+        # so a tile hit normally costs a single GET.
+        now = time()
+        version, checked = self._versions.get(layer, (None, 0))
+        if now - checked > settings.TILE_VERSION_CHECK_SECONDS:
+            version = self.db.get("ga.tiles.version:" + layer) or b"0"
+            self._versions[layer] = (version, now)
+        return version.decode("ascii")
+
+    def key(self, layer, style, z, x, y, version=None):
+        # ``version`` defaults to the layer's current one.
+        if version is None:
+            version = self.version(layer)
+        return "ga.tiles:%s:%s:%s:%d:%d:%d" % (layer, version, style, z, x, y)
+
+    def get(self, layer, style, z, x, y):
+        return self.db.get(self.key(layer, style, z, x, y))
+
+    def get_many(self, layer, style, tiles, version=None):
+        """
+        The data of each of ``tiles``, ``None`` where it isn't cached.
+        """
+        if version is None:
+            version = self.version(layer)
+        return self.db.mget([self.key(layer, style, z, x, y, version) for z, x, y in tiles])
+
+    def set_many(self, layer, style, tiles, version=None):
+        """
+        Store ``{(z, x, y): data}`` in one transaction.
+        """
+        if version is None:
+            version = self.version(layer)
+        pipe = self.db.pipeline()
+        for (z, x, y), data in tiles.items():
+            # WMS_CACHE_DB is a redis.Redis, so setex takes the value first.
+            pipe.setex(self.key(layer, style, z, x, y, version), data,
+                       settings.TILE_CACHE_SECONDS)
+        pipe.execute()
+
+    def set(self, layer, style, z, x, y, data):
+        self.set_many(layer, style, {(z, x, y): data})
+
+    def missing(self, layer, style, tiles):
+        """
+        The tiles among ``tiles`` that aren't cached.
+        """
+        pipe = self.db.pipeline()
+        for z, x, y in tiles:
+            pipe.exists(self.key(layer, style, z, x, y))
+        return [tile for tile, cached in zip(tiles, pipe.execute()) if not cached]
+
+    def invalidate(self, layer):
+        """
+        Drop every cached tile of ``layer``, in this process and all others
+        within ``TILE_VERSION_CHECK_SECONDS``.
+        """
+        self.db.incr("ga.tiles.version:" + layer)
+        self._versions.pop(layer, None)
+
+
+tile_cache = TileCache()
@@ -0,0 +1,289 @@
+"""
+Resumable uploads of large datasets, following the tus protocol
+(http://tus.io/protocols/resumable-upload.html).
+
+A client creates an upload giving its total length, then sends the file
+in chunks, each starting at the offset the server reports. Chunks are
+streamed from the request straight into a file under ``BLOB_ROOT``, so
+nothing is spooled and a dropped connection only costs the chunk in
+flight. A chunk may carry its own ``Upload-Checksum`` and is refused and
+rolled back if it doesn't match; a CRC32 of everything received so far
+is kept as it arrives, so a whole-file ``crc32`` given with the upload
+is checked without reading the file again.
+
+Zip archives are checked member by member as their chunks arrive (see
+``geoanalytics.archives``), so a file that isn't one is refused early.
+Once the last chunk lands the file is moved into ``datasets/`` and the
+``ingest_upload`` task inspects any shapefiles in it and turns it into
+a data resource.
+
+The state of each upload is a Redis hash that expires after
+``UPLOAD_EXPIRE_SECONDS`` without a chunk.
+
+The upload endpoints are CSRF protected like the rest of the site, so
+every POST, PATCH and DELETE has to carry the ``csrftoken`` cookie's
+value in an ``X-CSRFToken`` header; tus clients take it as a custom
+header (``headers`` in tus-js-client).
+"""
+from __future__ import absolute_import, unicode_literals
+
+import base64
+import errno
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import zipfile
+import zlib
+
+from django.conf import settings
+from django.utils.text import get_valid_filename
+
+from geoanalytics import locks
+from geoanalytics.archives import ArchiveError, ZipScanner, inspect, is_zip
+from geoanalytics.blobs import BlobStore
+
+CHECKSUM_ALGORITHMS = ("md5", "sha1", "sha256")
+
+parts = BlobStore("upload_parts")
+
+
+class UploadError(Exception):
+    status = 400
+
+
+class UploadNotFound(UploadError):
+    status = 404
+
+
+class UploadTooLarge(UploadError):
+    status = 413
+
+
+class OffsetMismatch(UploadError):
+    status = 409
+
+
+class UploadLocked(UploadError):
+    status = 423
+
+
+class ChecksumMismatch(UploadError):
+    status = 460
+
+
+class InvalidArchive(UploadError):
+    status = 422
+
+
+def _redis():
+    return settings.REDIS_CONNECTION
+
+
+def _key(upload_id):
+    return "ga.uploads:%s" % upload_id
+
+
+def dataset_name(upload_id, filename):
+    """
+    Where a finished upload is kept, relative to ``MEDIA_ROOT``.
+    """
+    return "datasets/%s/%s" % (upload_id, filename)
+
+
+def create(user_id, filename, length, crc32=None):
+    """
+    Start an upload of ``length`` bytes and return its id.
+    """
+    if length > settings.UPLOAD_MAX_BYTES:
+        raise UploadTooLarge("Uploads are limited to %d bytes" % settings.UPLOAD_MAX_BYTES)
+    upload_id = uuid.uuid4().hex
+    path = parts.path(upload_id)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    open(path, "wb").close()
+    state = {
+        "user": user_id,
+        "filename": get_valid_filename(os.path.basename(filename)) or upload_id,
+        "length": length,
+        "offset": 0,
+        "crc32": 0,
+        "status": "uploading",
+    }
+    if crc32 is not None:
+        state["expected_crc32"] = crc32
+    key = _key(upload_id)
+    with _redis().pipeline() as pipe:
+        pipe.hmset(key, state)
+        pipe.expire(key, settings.UPLOAD_EXPIRE_SECONDS)
+        pipe.execute()
+    return upload_id
+
+
+def get(upload_id):
+    state = _redis().hgetall(_key(upload_id))
+    if not state:
+        raise UploadNotFound(upload_id)
+    for field in ("length", "offset", "crc32"):
+        state[field] = int(state[field])
+    return state
+
+
+def _parse_checksum(header):
+    try:
+        algorithm, digest = header.split(" ", 1)
+        digest = base64.b64decode(digest)
+    except (ValueError, TypeError):
+        raise UploadError("Malformed Upload-Checksum")
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise UploadError("Unsupported checksum algorithm %r" % algorithm)
+    return hashlib.new(algorithm), digest
+
+
+def append(upload_id, offset, stream, size, checksum=None):
+    """
+    Write a chunk of ``size`` bytes read from ``stream`` at ``offset``,
+    and return the new offset. ``checksum`` is the value of the chunk's
+    ``Upload-Checksum`` header, if it has one. Completes the upload when
+    this was the last chunk.
+    """
+    lock = "ga.uploads.lock:%s" % upload_id
+    token = locks.new_token()
+    if not _redis().set(lock, token, nx=True, ex=settings.UPLOAD_LOCK_SECONDS):
+        raise UploadLocked("Another chunk of this upload is being written")
+    try:
+        state = get(upload_id)
+        if state["status"] != "uploading":
+            raise OffsetMismatch("Upload is already complete")
+        if offset != state["offset"]:
+            raise OffsetMismatch("Upload is at offset %d" % state["offset"])
+        if offset + size > state["length"]:
+            raise UploadTooLarge("Chunk runs past the end of the upload")
+        digest = None
+        if checksum:
+            digest, expected = _parse_checksum(checksum)
+        crc = state["crc32"]
+        written = 0
+        with open(parts.path(upload_id), "r+b") as f:
+            f.seek(offset)
+            try:
+                while written < size:
+                    data = stream.read(min(settings.UPLOAD_BUFFER_BYTES, size - written))
+                    if not data:
+                        break
+                    f.write(data)
+                    crc = zlib.crc32(data, crc)
+                    if digest is not None:
+                        digest.update(data)
+                    written += len(data)
+            finally:
+                # Whatever arrived before a dropped connection is kept,
+                # unless the chunk has a checksum that can't be checked.
+                if digest is not None and (written < size or digest.digest() != expected):
+                    f.truncate(offset)
+                    written, crc = 0, state["crc32"]
+                else:
+                    f.truncate(offset + written)
+                f.flush()
+            if digest is not None and written < size:
+                raise ChecksumMismatch("Chunk checksum mismatch")
+            new_offset = offset + written
+            if is_zip(state["filename"]):
+                scanner = ZipScanner(json.loads(state["scan"]) if "scan" in state else None)
+                try:
+                    scanner.scan(f, new_offset)
+                except ArchiveError as e:
+                    delete(upload_id)
+                    raise InvalidArchive(str(e))
+        key = _key(upload_id)
+        fields = {"offset": new_offset, "crc32": crc}
+        if is_zip(state["filename"]):
+            fields["scan"] = json.dumps(scanner.state)
+        with _redis().pipeline() as pipe:
+            pipe.hmset(key, fields)
+            pipe.expire(key, settings.UPLOAD_EXPIRE_SECONDS)
+            pipe.execute()
+        if new_offset == state["length"]:
+            complete(upload_id)
+    finally:
+        # A slow chunk may outlive the lock, which another request may
+        # then have taken.
+        locks.release(_redis(), lock, token)
+    return new_offset
+
+
+def complete(upload_id):
+    """
+    Check the whole file, move it into ``datasets/`` and queue its
+    ingest. Only call it with the upload's lock held, as ``append``
+    does, so it runs once however many requests reach the last offset.
+    """
+    from geoanalytics.tasks import ingest_upload
+
+    state = get(upload_id)
+    if state["status"] != "uploading":
+        raise OffsetMismatch("Upload is already complete")
+    expected = state.get("expected_crc32")
+    if expected is not None and int(expected, 16) != state["crc32"] & 0xffffffff:
+        delete(upload_id)
+        raise ChecksumMismatch("Upload crc32 mismatch")
+    name = dataset_name(upload_id, state["filename"])
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # BLOB_ROOT and MEDIA_ROOT may be on different file systems.
+    shutil.move(parts.path(upload_id), path)
+    _redis().hmset(_key(upload_id), {"status": "complete", "path": name})
+    ingest_upload.delay(upload_id)
+
+
+def delete(upload_id):
+    parts.delete(upload_id)
+    _redis().delete(_key(upload_id))
+
+
+def ingest(upload_id):
+    """
+    Make a data resource of a completed upload and return its slug.
+    """
+    from ga_resources.models import DataResource
+
+    state = get(upload_id)
+    key = _key(upload_id)
+    _redis().hset(key, "status", "ingesting")
+    try:
+        if is_zip(state["filename"]):
+            # Checks every member name, including any after one with a
+            # data descriptor that couldn't be checked during the upload.
+            try:
+                layers = inspect(os.path.join(settings.MEDIA_ROOT, state["path"]))
+            except (zipfile.BadZipfile, ArchiveError):
+                _redis().hset(key, "status", "invalid")
+                raise
+            _redis().hset(key, "layers", json.dumps(layers))
+        resource = DataResource.objects.create(
+            title=os.path.splitext(state["filename"])[0],
+            resource_file=state["path"],
+            owner_id=state["user"],
+        )
+    except Exception:
+        if _redis().hget(key, "status") == "ingesting":
+            _redis().hset(key, "status", "failed")
+        raise
+    _redis().hmset(key, {"status": "ingested", "resource": resource.slug})
+    return resource.slug
+
+
+def purge(max_age):
+    """
+    Delete partial uploads that haven't had a chunk for ``max_age``
+    seconds; their Redis state has expired by then.
+    """
+    return parts.purge(max_age)
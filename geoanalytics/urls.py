@@ -2,7 +2,9 @@ from __future__ import unicode_literals, absolute_import
 
 from django.conf.urls import patterns, include, url
 from django.conf.urls.i18n import i18n_patterns
+from django.conf.urls.static import static
 from django.contrib import admin
+from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.views.generic import RedirectView
 
 from mezzanine.core.views import direct_to_template
@@ -29,10 +31,16 @@ urlpatterns = i18n_patterns("",
     (r'^inplaceeditform/', include('inplaceeditform.urls')),
     (r'^jsi18n$', 'django.views.i18n.javascript_catalog', js_info_dict),
 
+    url("^admin/task-stats/$", "geoanalytics.views.task_stats_admin",
+        name="task_stats_admin"),
     ("^admin/", include(admin.site.urls)),
     
     # TERRAHUB URLS
     ("^ga_resources/", include("ga_resources.urls")),
+    url("^stats/requests/$", "geoanalytics.views.request_stats_json",
+        name="request_stats"),
+    url("^stats/tasks/$", "geoanalytics.views.task_stats_json",
+        name="task_stats"),
     ("^favicon.ico", RedirectView.as_view(url='/static/favicon.ico')),
 )
 
@@ -43,8 +51,23 @@ if getattr(settings, "PACKAGE_NAME_FILEBROWSER") in settings.INSTALLED_APPS:
                                         settings.PACKAGE_NAME_FILEBROWSER)),
     )
 
+# The Docker image runs gunicorn with DEBUG on and no web server in
+# front of it, so Django serves static files and media there. They
+# have to come before Mezzanine's catch all pattern for pages.
+if settings.DEBUG:
+    urlpatterns += staticfiles_urlpatterns()
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
 urlpatterns += patterns('',
 
+    url(r"^tiles/(?P<layer>.+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.png$",
+        "geoanalytics.views.tile", name="tile"),
+    url(r"^download/(?P<slug>.+)$", "geoanalytics.views.download",
+        name="download"),
+    url(r"^uploads/$", "geoanalytics.views.upload", name="uploads"),
+    url(r"^uploads/(?P<upload_id>[0-9a-f]{32})$", "geoanalytics.views.upload",
+        name="upload"),
+
     # We don't want to presume how your homepage works, so here are a
     # few patterns you can use to set it up.
 
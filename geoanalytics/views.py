@@ -0,0 +1,217 @@
+from __future__ import absolute_import, unicode_literals
+
+import base64
+import json
+import logging
+import mimetypes
+import os
+from wsgiref.util import FileWrapper
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
+from django.shortcuts import render
+from django.utils.cache import patch_cache_control
+
+from geoanalytics import permissions, rendering, styles, uploads
+from geoanalytics.instrumentation import request_stats, task_stats
+
+logger = logging.getLogger(__name__)
+
+
+def _json_response(data):
+    return HttpResponse(json.dumps(data, indent=2, sort_keys=True),
+                        content_type="application/json")
+
+
+@staff_member_required
+def request_stats_json(request):
+    """
+    Rolling per-view request statistics. ``?seconds=`` narrows the
+    window, which defaults to everything retained.
+    """
+    seconds = int(request.GET.get("seconds", 0)) or None
+    return _json_response(request_stats.read(seconds))
+
+
+@staff_member_required
+def task_stats_json(request):
+    """
+    Rolling per-task statistics, like ``request_stats_json``.
+    """
+    seconds = int(request.GET.get("seconds", 0)) or None
+    return _json_response(task_stats.read(seconds))
+
+
+@staff_member_required
+def task_stats_admin(request):
+    """
+    Admin page tabulating ``task_stats_json``, busiest tasks first.
+    """
+    seconds = int(request.GET.get("seconds", 0)) or None
+    stats = task_stats.read(seconds)
+    tasks = sorted(stats.items(), key=lambda item: -item[1]["counters"].get("tasks", 0))
+    return render(request, "admin/task_stats.html", {
+        "title": "Task statistics",
+        "tasks": [dict(task, name=name) for name, task in tasks],
+    })
+
+
+def _check_layer_access(request, layer):
+    key = permissions.user_key(request, "layer", layer)
+    if permissions.is_allowed(request, key):
+        return
+    from ga_resources.models import RenderedLayer
+    if permissions.viewable_page(request, RenderedLayer, layer) is None:
+        raise Http404
+    permissions.remember(request, key)
+
+
+def _layer_is_public(request, layer):
+    # Anonymous users' decisions are memoized under a user id of None.
+    key = (None, "layer", layer)
+    if permissions.memo.get(key):
+        return True
+    from ga_resources.models import RenderedLayer
+    anonymous = permissions.anonymous_request(request)
+    if permissions.viewable_page(anonymous, RenderedLayer, layer) is not None:
+        permissions.memo.set(key)
+        return True
+    return False
+
+
+def tile(request, layer, z, x, y):
+    """
+    A 256px spherical mercator PNG tile of a rendered layer. ``?style=``
+    picks one of the layer's styles instead of its default.
+    """
+    _check_layer_access(request, layer)
+    z, x, y = int(z), int(x), int(y)
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise Http404
+    try:
+        data = rendering.tile(layer, request.GET.get("style", ""), z, x, y)
+    except styles.StyleNotReady:
+        response = HttpResponse(status=503)
+        response["Retry-After"] = "2"
+        return response
+    except styles.StyleError as e:
+        # The layer's stylesheet doesn't compile; retrying won't help.
+        # carto's message names server paths, so it only goes to the log.
+        logger.error("Style of %s doesn't compile: %s", layer, e)
+        return HttpResponse("The layer's style doesn't compile.", status=422,
+                            content_type="text/plain")
+    response = HttpResponse(data, content_type="image/png")
+    # Tiles anyone may see can be kept by nginx and browsers; see the
+    # tile cache in deploy/nginx.conf.
+    if _layer_is_public(request, layer):
+        patch_cache_control(response, public=True,
+                            max_age=settings.TILE_PUBLIC_CACHE_SECONDS)
+    else:
+        patch_cache_control(response, private=True)
+    return response
+
+
+def download(request, slug):
+    """
+    The file of a data resource, for users who may see it. Behind nginx
+    (``USE_X_ACCEL_REDIRECT``) Django only authorizes the download and
+    nginx sends the file from ``X_ACCEL_REDIRECT_PREFIX``.
+    """
+    from ga_resources.models import DataResource
+    resource = permissions.viewable_page(request, DataResource, slug)
+    if resource is None or not resource.resource_file:
+        raise Http404
+    name = resource.resource_file.name
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if settings.USE_X_ACCEL_REDIRECT:
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = settings.X_ACCEL_REDIRECT_PREFIX + name
+    else:
+        path = resource.resource_file.path
+        response = StreamingHttpResponse(FileWrapper(open(path, "rb")),
+                                         content_type=content_type)
+        response["Content-Length"] = os.path.getsize(path)
+    response["Content-Disposition"] = 'attachment; filename="%s"' % os.path.basename(name)
+    return response
+
+
+TUS_VERSION = "1.0.0"
+
+
+def _tus_response(status=204, **headers):
+    response = HttpResponse(status=status)
+    response["Tus-Resumable"] = TUS_VERSION
+    for name, value in headers.items():
+        response[name.replace("_", "-")] = value
+    return response
+
+
+def _upload_metadata(header):
+    metadata = {}
+    for pair in header.split(","):
+        name, _, value = pair.strip().partition(" ")
+        if name:
+            metadata[name] = base64.b64decode(value).decode("utf-8")
+    return metadata
+
+
+def upload(request, upload_id=None):
+    """
+    Resumable dataset uploads, see ``geoanalytics.uploads``. POST to
+    ``uploads/`` creates one; HEAD gives its offset, PATCH appends a chunk
+    and DELETE abandons it. GET reports its progress, the shapefiles found
+    in it and, once ingested, the slug of its data resource. POST, PATCH
+    and DELETE need the CSRF token in an ``X-CSRFToken`` header.
+    """
+    if request.method == "OPTIONS":
+        return _tus_response(Tus_Version=TUS_VERSION,
+                             Tus_Extension="creation,checksum,termination",
+                             Tus_Max_Size=settings.UPLOAD_MAX_BYTES,
+                             Tus_Checksum_Algorithm=",".join(uploads.CHECKSUM_ALGORITHMS))
+    if not request.user.is_authenticated():
+        return _tus_response(403)
+    try:
+        if upload_id is None:
+            if request.method != "POST":
+                return HttpResponseNotAllowed(["OPTIONS", "POST"])
+            metadata = _upload_metadata(request.META.get("HTTP_UPLOAD_METADATA", ""))
+            upload_id = uploads.create(request.user.pk, metadata.get("filename", ""),
+                                       int(request.META["HTTP_UPLOAD_LENGTH"]),
+                                       metadata.get("crc32"))
+            location = request.build_absolute_uri(reverse("upload", args=(upload_id,)))
+            return _tus_response(201, Location=location)
+
+        state = uploads.get(upload_id)
+        if state["user"] != str(request.user.pk):
+            raise Http404
+        if request.method == "HEAD":
+            return _tus_response(200, Upload_Offset=state["offset"],
+                                 Upload_Length=state["length"], Cache_Control="no-store")
+        if request.method == "GET":
+            progress = dict((field, state.get(field)) for field in
+                            ("filename", "length", "offset", "status", "resource"))
+            progress["layers"] = json.loads(state.get("layers", "null"))
+            response = _json_response(progress)
+            patch_cache_control(response, no_store=True)
+            return response
+        if request.method == "PATCH":
+            if request.META.get("CONTENT_TYPE") != "application/offset+octet-stream":
+                return _tus_response(415)
+            offset = uploads.append(upload_id, int(request.META["HTTP_UPLOAD_OFFSET"]),
+                                    request, int(request.META["CONTENT_LENGTH"]),
+                                    request.META.get("HTTP_UPLOAD_CHECKSUM"))
+            return _tus_response(Upload_Offset=offset)
+        if request.method == "DELETE":
+            uploads.delete(upload_id)
+            return _tus_response()
+        return HttpResponseNotAllowed(["OPTIONS", "HEAD", "GET", "PATCH", "DELETE"])
+    except (KeyError, ValueError, TypeError):
+        return _tus_response(400)
+    except uploads.UploadNotFound:
+        raise Http404
+    except uploads.UploadError as e:
+        response = _tus_response(e.status)
+        response.content = str(e)
+        return response
@@ -0,0 +1,113 @@
+"""
+Start-up work for preforking servers, and the gunicorn hooks that run it.
+
+``warm`` runs once in the gunicorn master, after the app is preloaded and
+before any worker is forked. It imports the heavy GIS and numeric
+libraries, loads every model and URL pattern and fills caches that are
+read-only afterwards, so workers share those pages copy-on-write instead
+of each building their own.
+
+Nothing that holds a connection may be shared across a fork:
+``close_connections`` drops the database connection and every Redis
+connection pool, and runs in the master before each fork and again in
+each new worker.
+
+``worker_exit`` flushes the worker's request statistics before it goes.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import importlib
+import random
+
+import redis
+from django.conf import settings
+from django.db import connections
+
+HEAVY_MODULES = (
+    "numpy",
+    "scipy",
+    "scipy.ndimage",
+    "osgeo.gdal",
+    "osgeo.ogr",
+    "osgeo.osr",
+    "mapnik",
+    "shapely.geometry",
+    "shapely.wkb",
+    "pyproj",
+    "fiona",
+    "celery",
+    "kombu",
+)
+
+
+def import_heavy_modules():
+    for name in HEAVY_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def load_django():
+    from django.core.urlresolvers import get_resolver
+    from django.db.models.loading import get_models
+
+    # Imports every app's models, and through the URLconf every view.
+    get_models()
+    get_resolver(None).url_patterns
+    from mezzanine.conf import settings as mezzanine_settings
+    # use_editable() only marks the editable settings for reloading;
+    # reading one of them is what loads them all from the database.
+    mezzanine_settings.use_editable()
+    mezzanine_settings.SITE_TITLE
+
+
+def warm_mapnik():
+    try:
+        import mapnik
+    except ImportError:
+        return
+    # Scans the font directories on first use.
+    mapnik.FontEngine.face_names()
+
+
+def warm():
+    import_heavy_modules()
+    load_django()
+    warm_mapnik()
+    close_connections()
+
+
+def close_connections():
+    for connection in connections.all():
+        connection.close()
+    for value in vars(settings._wrapped).values():
+        if isinstance(value, redis.StrictRedis):
+            value.connection_pool.disconnect()
+
+
+def when_ready(server):
+    warm()
+
+
+def pre_fork(server, worker):
+    close_connections()
+
+
+def post_fork(server, worker):
+    close_connections()
+    # Workers would otherwise all draw the same random numbers.
+    random.seed()
+    # Load the most used mapnik maps before taking requests, and have
+    # the worker replaced once the pool finds it has grown too big.
+    from geoanalytics.mappool import map_pool
+    map_pool.recycle = lambda: setattr(worker, "alive", False)
+    try:
+        map_pool.warm()
+    except Exception:
+        worker.log.exception("Couldn't warm the map pool")
+
+
+def worker_exit(server, worker):
+    from geoanalytics import instrumentation
+    instrumentation.flush_all()
@@ -2,6 +2,72 @@ from __future__ import unicode_literals
 
 import os
 
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "geoanalytics.settings")
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.wsgi import WSGIHandler
 from django.core.wsgi import get_wsgi_application
-application = get_wsgi_application()
+from django.utils.module_loading import import_by_path
+
+
+class SlimWSGIHandler(WSGIHandler):
+    """
+    A Django WSGI handler that loads ``FAST_PATH_MIDDLEWARE_CLASSES``
+    instead of ``MIDDLEWARE_CLASSES``. Tiles, features and API calls
+    need a user and a permission check, not locale, CSRF, messages,
+    device templates or a page tree lookup.
+    """
+
+    def load_middleware(self):
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._response_middleware = []
+        self._exception_middleware = []
+
+        request_middleware = []
+        for middleware_path in settings.FAST_PATH_MIDDLEWARE_CLASSES:
+            mw_class = import_by_path(middleware_path)
+            try:
+                mw_instance = mw_class()
+            except MiddlewareNotUsed:
+                continue
+
+            if hasattr(mw_instance, 'process_request'):
+                request_middleware.append(mw_instance.process_request)
+            if hasattr(mw_instance, 'process_view'):
+                self._view_middleware.append(mw_instance.process_view)
+            if hasattr(mw_instance, 'process_template_response'):
+                self._template_response_middleware.insert(0, mw_instance.process_template_response)
+            if hasattr(mw_instance, 'process_response'):
+                self._response_middleware.insert(0, mw_instance.process_response)
+            if hasattr(mw_instance, 'process_exception'):
+                self._exception_middleware.insert(0, mw_instance.process_exception)
+
+        # Assigned last, as Django uses it as the "loaded" flag.
+        self._request_middleware = request_middleware
+
+
+class PrefixDispatcher(object):
+    """
+    Sends safe (read-only) requests whose path starts with one of
+    ``prefixes`` to ``fast_application`` and everything else to
+    ``application``. Writes always take the full middleware stack so
+    they keep CSRF protection.
+    """
+    safe_methods = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, application, fast_application, prefixes):
+        self.application = application
+        self.fast_application = fast_application
+        self.prefixes = tuple(prefixes)
+
+    def __call__(self, environ, start_response):
+        if (environ.get("REQUEST_METHOD") in self.safe_methods and
+                environ.get("PATH_INFO", "").startswith(self.prefixes)):
+            return self.fast_application(environ, start_response)
+        return self.application(environ, start_response)
+
 
+application = PrefixDispatcher(get_wsgi_application(), SlimWSGIHandler(),
+                               settings.FAST_PATH_PREFIXES)